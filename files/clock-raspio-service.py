@@ -1,23 +1,74 @@
 #!/usr/bin/python3
 import time
+# Taken first, so the startup timings include the imports
+STARTUP_BEGIN = time.perf_counter()
 import http.server
 import signal
 import os
 import logging
+import logging.handlers
 import sys
 import json
 import shutil
 import datetime
-import jinja2
-import hashlib
-import requests
 import subprocess
-import cgi
 import urllib
-
-
-SOUNDOUT_PERIOD = 1
-CONFIG_SAVE_PERIOD = 10
+import socket
+import selectors
+import bisect
+import threading
+import tempfile
+import math
+import functools
+import contextlib
+import collections
+import queue
+import re
+import atexit
+
+
+FADE_VOLUME_RESOLUTION = 1
+FADE_MIN_STEP_PERIOD = 0.1
+SCHEDULER_MAX_SLEEP = 60
+MPD_HOST = 'localhost'
+MPD_PORT = 6600
+MPD_TIMEOUT = 5
+# Zone driving MPD_HOST:MPD_PORT with config.current_profile_name, the other zones come from config.zones
+DEFAULT_ZONE_NAME = 'default'
+WEBADMIN_PORT = 80
+WEBADMIN_TIMEOUT = 30
+WEBADMIN_BACKLOG = 128
+AUDIO_PREFETCH_PERIOD = 30
+AUDIO_PREFETCH_POLL_PERIOD = 1
+AUDIO_PROBE_TIMEOUT = 5
+AUDIO_PROBE_WORKERS = 4
+CONFIG_SAVE_PERIOD = 10*60
+CONFIG_JOURNAL_MAX_RECORDS = 100
+# Bumped when the config file format changes, so older files get rewritten on startup
+CONFIG_FORMAT_VERSION = 1
+FILES_CHUNK_SIZE = 64*1024
+FILES_MAX_UPLOAD_SIZE = 512*1024*1024
+RENDER_CACHE_MAX_ENTRIES = 32
+STATUS_KEEPALIVE_PERIOD = 15
+CONFIG_PAGE_SIZE = 100
+CONFIG_MAX_PAGE_SIZE = 1000
+LIBRARY_REFRESH_PERIOD = 15*60
+LIBRARY_PAGE_SIZE = 50
+LIBRARY_MAX_PAGE_SIZE = 500
+MEDIA_CACHE_MAX_SIZE = 1024*1024*1024
+MEDIA_CACHE_WORKERS = 3
+MEDIA_CACHE_TIMEOUT = 30
+MEDIA_CACHE_PERIOD = 5*60
+MEDIA_CACHE_AHEAD_PERIOD = 12*60*60
+MEDIA_CACHE_MAX_TIMESLOTS = 32
+LIBRARY_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.oga', '.opus', '.wav', '.m4a', '.aac', '.wma')
+LOG_QUEUE_SIZE = 10000
+LOG_COALESCE_PERIOD = 30
+LOG_NAME = 'clock-raspio'
+LOG_SUBSYSTEMS = ('audio', 'cache', 'config', 'library', 'update', 'webadmin')
+# subsystem : level, the others log everything. Requests are logged at DEBUG
+LOG_LEVELS = {'webadmin' : 'INFO'}
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
 DEVEL_MODE = True
 #LIB_FOLDER_PATH = '/var/lib/clock-raspio/'
 #SHARE_FOLDER_PATH = '/usr/share/clock-raspio/'
@@ -28,15 +79,27 @@ UPDATED_PROGRAM_FILE_NAME    = 'clock-raspio.py'
 UPDATED_CSS_FILE_NAME        = 'stylesheet.css'
 UPDATED_TEMPLATE_FILE_NAME   = 'template.html'
 
-UPDATE_URLS = {
-   'clock-raspio.py' : 'https://raw.githubusercontent.com/Gugli/clock-raspio/master/files/clock-raspio-service.py',
-   'stylesheet.css'  : 'https://raw.githubusercontent.com/Gugli/clock-raspio/master/files/share/stylesheet.css',
-   'template.html'   : 'https://raw.githubusercontent.com/Gugli/clock-raspio/master/files/share/template.html'
+UPDATE_BASE_URL = 'https://raw.githubusercontent.com/Gugli/clock-raspio/master/files/'
+# Installed file name : path under UPDATE_BASE_URL
+UPDATE_PATHS = {
+   'clock-raspio.py' : 'clock-raspio-service.py',
+   'stylesheet.css'  : 'share/stylesheet.css',
+   'template.html'   : 'share/template.html'
 }
+# Lists the SHA-256 of each file under UPDATE_BASE_URL, written by tools/clock-raspio-manifest.py
+UPDATE_MANIFEST_PATH = 'update-manifest.json'
+UPDATE_TIMEOUT = 30
 
 
 CONFIG_FILE_PATH        = LIB_FOLDER_PATH + 'config.json'
+CONFIG_JOURNAL_FILE_PATH = LIB_FOLDER_PATH + 'config.journal'
 FILES_FOLDER_PATH        = LIB_FOLDER_PATH + 'files/'
+MUSIC_FOLDER_PATH        = LIB_FOLDER_PATH + 'music/'
+LIBRARY_FILE_PATH        = LIB_FOLDER_PATH + 'library.sqlite'
+TEMPLATE_CACHE_FOLDER_PATH = LIB_FOLDER_PATH + 'template-cache/'
+MEDIA_CACHE_FOLDER_PATH  = LIB_FOLDER_PATH + 'cache/'
+UPDATE_STATE_FILE_PATH   = LIB_FOLDER_PATH + 'update-state.json'
+UPDATE_SWAP_FILE_PATH    = LIB_FOLDER_PATH + 'update-swap.json'
 EXAMPLE_FILE_NAME       = 'wind-chimes_by_inspectorj.flac'
 CSS_FILE_PATH           = SHARE_FOLDER_PATH + 'stylesheet.css'
 TEMPLATE_FILE_PATH      = SHARE_FOLDER_PATH + 'template.html'
@@ -50,10 +113,20 @@ class SignalHandler:
         if signum == signal.SIGTERM:
             self.must_leave = True
 
-def timezone_list():
+ZONEINFO_FOLDER_PATH    = '/usr/share/zoneinfo'
+TIMEZONE_FILE_PATH      = '/etc/timezone'
+# Wait before running timedatectl again once it failed
+TIMEZONE_RETRY_PERIOD   = 5*60
+
+def timezone_read_list():
+    """Returns None if timedatectl failed or is missing."""
     if os.name == 'nt': return {"Continent" : ["Timezone1", "Timezone2"]}
-    process = subprocess.Popen(["timedatectl", "list-timezones"], stdout=subprocess.PIPE)
-    (stdout, stderr) = process.communicate()
+    try:
+        process = subprocess.Popen(["timedatectl", "list-timezones"], stdout=subprocess.PIPE)
+        (stdout, stderr) = process.communicate()
+    except OSError:
+        return None
+    if process.returncode != 0: return None
     timezones = {}
     for line in stdout.splitlines():
         values = line.decode('utf-8').split('/')
@@ -65,15 +138,400 @@ def timezone_list():
         timezones[continent].append(zone)
     return timezones
 
-def timezone_get():
+def timezone_read_current():
     if os.name == 'nt': return "Continent/Timezone2"
-    process = subprocess.Popen(["cat", "/etc/timezone"], stdout=subprocess.PIPE)
-    (stdout, stderr) = process.communicate()
-    return stdout.decode('utf-8').strip()
+    try:
+        with open(TIMEZONE_FILE_PATH, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return ""
+
+class TimezoneCache:
+    """Keeps the timezone catalogue and the current timezone, reading them
+    again only when the files they come from have been modified."""
+
+    def __init__(self):
+        self.lock            = threading.Lock()
+        self.timezones       = None
+        self.timezones_mtime = None
+        # Set while the catalogue could not be read, the time it is read again
+        self.timezones_retry_time = None
+        self.current         = None
+        self.current_mtime   = None
+        # Bumped whenever the catalogue or the current timezone changes
+        self.version         = 0
+
+    @staticmethod
+    def get_mtime(path):
+        try: return os.stat(path).st_mtime_ns
+        except OSError: return None
+
+    def is_list_stale(self, mtime):
+        # Installing a tzdata update replaces files in the folder, which changes its mtime
+        return (self.timezones == None or mtime != self.timezones_mtime
+            or (self.timezones_retry_time != None and time.monotonic() >= self.timezones_retry_time))
+
+    def list(self):
+        mtime = self.get_mtime(ZONEINFO_FOLDER_PATH)
+        with self.lock:
+            if self.is_list_stale(mtime):
+                timezones = timezone_read_list()
+                # An empty catalogue until timedatectl is tried again, not on every page
+                self.timezones_retry_time = time.monotonic() + TIMEZONE_RETRY_PERIOD if timezones == None else None
+                if timezones == None: timezones = {}
+                if timezones != self.timezones: self.version += 1
+                self.timezones = timezones
+                self.timezones_mtime = mtime
+            return self.timezones
+
+    def get_version(self):
+        """Version of what list() and get() return, told from the mtimes only:
+        it differs from any version seen so far while they would read again."""
+        timezones_mtime = self.get_mtime(ZONEINFO_FOLDER_PATH)
+        current_mtime = self.get_mtime(TIMEZONE_FILE_PATH)
+        with self.lock:
+            if self.is_list_stale(timezones_mtime) or self.current == None or current_mtime != self.current_mtime:
+                return '{0}s'.format(self.version)
+            return '{0}'.format(self.version)
+
+    def get(self):
+        mtime = self.get_mtime(TIMEZONE_FILE_PATH)
+        with self.lock:
+            if self.current == None or mtime != self.current_mtime:
+                current = timezone_read_current()
+                if current != self.current: self.version += 1
+                self.current = current
+                self.current_mtime = mtime
+            return self.current
+
+    def set(self, new_timezone):
+        """Returns False if timedatectl refused the timezone."""
+        returncode = 0
+        if os.name != 'nt':
+            try: returncode = subprocess.call(["timedatectl", "set-timezone", new_timezone])
+            except OSError: returncode = None
+        with self.lock:
+            if returncode != 0:
+                # Read again from the system, whatever it holds now
+                self.current_mtime = None
+                self.current = None
+                return False
+            if new_timezone != self.current: self.version += 1
+            self.current = new_timezone
+            self.current_mtime = self.get_mtime(TIMEZONE_FILE_PATH)
+            return True
+
+timezone_cache = TimezoneCache()
+
+def timezone_list():
+    return timezone_cache.list()
+
+def timezone_get():
+    return timezone_cache.get()
 
 def timezone_set(new_timezone):
-    if os.name == 'nt': return
-    subprocess.call(["timedatectl", "set-timezone", new_timezone])
+    return timezone_cache.set(new_timezone)
+
+class MetricsHistogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count  = 0
+        self.sum    = 0.
+
+class MetricsTimer:
+    __slots__ = ('metrics', 'name', 'label', 'begin')
+
+    def __init__(self, metrics, name, label):
+        self.metrics = metrics
+        self.name    = name
+        self.label   = label
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.begin, self.label)
+
+class Metrics:
+    """Histograms of durations in seconds, exposed in the Prometheus text
+    format and as JSON. Recording is a bisection and three additions."""
+
+    # name : (help, label name)
+    DESCRIPTIONS = {
+        'clock_raspio_tick_duration_seconds'    : ('Time spent handling a scheduler wakeup', None),
+        'clock_raspio_tick_lateness_seconds'    : ('Delay between the planned and the actual scheduler wakeup', None),
+        'clock_raspio_timeslot_lookup_seconds'  : ('Time to find the current and the next timeslots', None),
+        'clock_raspio_audio_command_seconds'    : ('Time to run an audio command against MPD', 'command'),
+        'clock_raspio_audio_latency_seconds'    : ('Time from posting an audio command to its completion', 'command'),
+        'clock_raspio_audio_queue_depth'        : ('Audio commands posted and not completed yet', None),
+        'clock_raspio_request_seconds'          : ('Time to handle a web admin request', 'route'),
+        'clock_raspio_config_save_seconds'      : ('Time to write the config file', None),
+        'clock_raspio_library_refresh_seconds'  : ('Time to bring the media library up to date', None),
+        'clock_raspio_library_search_seconds'   : ('Time to search the media library', None),
+        'clock_raspio_media_cache_download_seconds' : ('Time to download a remote file into the media cache', None),
+        'clock_raspio_media_cache_bytes'        : ('Size of the files in the media cache', None),
+        'clock_raspio_status_listeners'         : ('Clients listening to the live status', None),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        # name : function returning the current value, only called on export
+        self.gauges = {}
+
+    def observe(self, name, seconds, label = None):
+        position = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            if histogram == None:
+                histogram = self.histograms[(name, label)] = MetricsHistogram()
+            histogram.counts[position] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+
+    def timer(self, name, label = None):
+        return MetricsTimer(self, name, label)
+
+    def register_gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot_gauges(self):
+        with self.lock:
+            gauges = sorted(self.gauges.items())
+        return [(name, function()) for (name, function) in gauges]
+
+    def snapshot(self):
+        with self.lock:
+            return sorted([(name, label, list(histogram.counts), histogram.count, histogram.sum)
+                for ((name, label), histogram) in self.histograms.items()], key = lambda entry: (entry[0], entry[1] or ''))
+
+    def to_prometheus(self):
+        lines = []
+        previous_name = None
+        for (name, label, counts, count, total) in self.snapshot():
+            (description, label_name) = self.DESCRIPTIONS.get(name, ('', 'label'))
+            if name != previous_name:
+                lines.append('# HELP {0} {1}'.format(name, description))
+                lines.append('# TYPE {0} histogram'.format(name))
+                previous_name = name
+            labels = '' if label == None else '{0}="{1}",'.format(label_name, label.replace('\\', '\\\\').replace('"', '\\"'))
+            cumulated = 0
+            for (bound, bucket_count) in zip(METRICS_BUCKETS + ('+Inf',), counts):
+                cumulated += bucket_count
+                lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(name, labels, bound, cumulated))
+            labels = '{' + labels[:-1] + '}' if labels else ''
+            lines.append('{0}_sum{1} {2}'.format(name, labels, total))
+            lines.append('{0}_count{1} {2}'.format(name, labels, count))
+        for (name, value) in self.snapshot_gauges():
+            lines.append('# HELP {0} {1}'.format(name, self.DESCRIPTIONS.get(name, ('', None))[0]))
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.append('{0} {1}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        dct = {}
+        for (name, label, counts, count, total) in self.snapshot():
+            entry = {}
+            entry['buckets'] = dict(zip([str(bound) for bound in METRICS_BUCKETS + ('+Inf',)], counts))
+            entry['count'] = count
+            entry['sum'] = total
+            dct.setdefault(name, {})[label or ''] = entry
+        for (name, value) in self.snapshot_gauges():
+            dct[name] = {'' : {'value' : value}}
+        return dct
+
+metrics = Metrics()
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands the records over to the writer thread, so logging never waits
+    on the output. When the writer falls behind, records are dropped and
+    counted instead."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogWriter:
+    """Writes the queued records to the actual handlers from its own thread.
+
+    A record logged with extra={'coalesce' : True} that repeats the previous
+    one of its logger, but for its numbers, is held back. The repetitions are
+    written as one summary when something else is logged or after
+    LOG_COALESCE_PERIOD, so a fade takes a few lines instead of one per
+    volume step. Other records are written as they are."""
+
+    NUMBERS = re.compile(r'\d+')
+
+    def __init__(self, log_queue, queue_handler, handlers, coalesce_period = LOG_COALESCE_PERIOD):
+        self.queue           = log_queue
+        self.queue_handler   = queue_handler
+        self.handlers        = handlers
+        self.coalesce_period = coalesce_period
+        # logger name : [key, time of the first record, latest record, repetitions]
+        self.pending         = {}
+        self.thread          = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread == None: return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.coalesce_period)
+            except queue.Empty:
+                self.flush(time.time())
+                continue
+            if record == None: break
+            self.write(record)
+            self.flush(record.created)
+        self.flush(None)
+
+    def write(self, record):
+        if self.queue_handler.dropped > 0:
+            dropped = self.queue_handler.dropped
+            self.queue_handler.dropped = 0
+            self.emit(logging.makeLogRecord({'name' : LOG_NAME, 'levelno' : logging.WARNING, 'levelname' : 'WARNING',
+                'msg' : 'Logging : {0} messages dropped, the output is too slow'.format(dropped)}))
+        pending = self.pending.pop(record.name, None)
+        if not getattr(record, 'coalesce', False):
+            if pending != None: self.summarize(pending)
+            self.emit(record)
+            return
+        key = (record.levelno, self.NUMBERS.sub('#', record.getMessage()))
+        if pending != None and pending[0] == key:
+            pending[2] = record
+            pending[3] += 1
+            self.pending[record.name] = pending
+            return
+        if pending != None: self.summarize(pending)
+        self.pending[record.name] = [key, record.created, record, 0]
+        self.emit(record)
+
+    def flush(self, now):
+        # Summarizes the repetitions held for too long, all of them if now is None
+        for name in list(self.pending):
+            pending = self.pending[name]
+            if now == None or now >= pending[1] + self.coalesce_period:
+                self.summarize(pending)
+                del self.pending[name]
+
+    def summarize(self, pending):
+        (key, first_created, record, repetitions) = pending
+        if repetitions == 0: return
+        if repetitions > 1:
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = '{0} ({1} similar messages in {2:.1f}s)'.format(record.getMessage(), repetitions, record.created - first_created)
+            record.args = None
+        self.emit(record)
+        pending[3] = 0
+
+    def emit(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level: handler.handle(record)
+
+def log_get_levels():
+    return dict([(subsystem, logging.getLevelName(logging.getLogger(LOG_NAME).getChild(subsystem).getEffectiveLevel())) for subsystem in LOG_SUBSYSTEMS])
+
+def log_set_levels(levels):
+    """Sets the level of some subsystems, {subsystem : level name}. Raises
+    ValueError and changes nothing if one of them is unknown."""
+    for (subsystem, level) in levels.items():
+        if not subsystem in LOG_SUBSYSTEMS: raise ValueError('Unknown subsystem {0}'.format(subsystem))
+        if not isinstance(level, str) or not isinstance(logging.getLevelName(level.upper()), int): raise ValueError('Unknown level {0}'.format(level))
+    for (subsystem, level) in levels.items():
+        logging.getLogger(LOG_NAME).getChild(subsystem).setLevel(level.upper())
+
+class WebadminServer(http.server.ThreadingHTTPServer):
+    # Listeners of the live status connect all at once when the daemon restarts
+    request_queue_size = WEBADMIN_BACKLOG
+
+class StatusChannel:
+    """Latest status of each zone published by the scheduler, waited for by
+    the clients listening to the live status.
+
+    Publishing is a comparison with the previous status, and a wakeup of the
+    waiting threads when it changed. Each listener then sends it from its own
+    thread, a slow one only skips the intermediate statuses."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # zone name : status, replaced rather than modified so listeners can read it unlocked
+        self.statuses  = {}
+        self.version   = 0
+        self.listeners = 0
+        # Versions restart at 0 with the daemon, the start time keeps older event ids from matching
+        self.epoch     = '{0:x}'.format(int(time.time()))
+
+    def publish(self, zone_name, status):
+        with self.condition:
+            if status == self.statuses.get(zone_name): return
+            self.statuses = dict(self.statuses)
+            self.statuses[zone_name] = status
+            self.version += 1
+            self.condition.notify_all()
+
+    def remove(self, zone_name):
+        with self.condition:
+            if not zone_name in self.statuses: return
+            self.statuses = dict(self.statuses)
+            del self.statuses[zone_name]
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Returns (version, statuses) once the statuses are newer than version,
+        or the current ones after timeout."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return (self.version, self.statuses)
+
+status_channel = StatusChannel()
+
+class RenderCache:
+    """Rendered pages, plain and gzip compressed, stored with the ETag of
+    the config and timezone versions they were rendered at."""
+
+    def __init__(self, max_entries = RENDER_CACHE_MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.max_entries = max_entries
+        # Versions restart at 0 with the daemon, the start time keeps older ETags from matching
+        self.epoch = '{0:x}'.format(int(time.time()))
+
+    def get_etag(self, *versions):
+        return '"' + '-'.join([self.epoch] + [str(version) for version in versions]) + '"'
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry == None or entry[0] != etag: return None
+        return entry
+
+    def put(self, key, etag, body):
+        import gzip
+        entry = (etag, body, gzip.compress(body))
+        with self.lock:
+            if len(self.entries) >= self.max_entries and not key in self.entries:
+                self.entries = {}
+            self.entries[key] = entry
+        return entry
 
 class WebadminHandler(http.server.BaseHTTPRequestHandler):
 
@@ -87,14 +545,27 @@ class WebadminHandler(http.server.BaseHTTPRequestHandler):
     POST_PLAYLIST_ADD_ITEM   = 8
     POST_PLAYLIST_REMOVE_ITEM   = 9
     POST_PLAYLIST_DELETE   = 10
+    POST_ZONE_SET      = 11
+    POST_ZONE_REMOVE   = 12
 
     GET_STYLESHEET      = 1
     #GET_INDEX           = 2
     GET_FAVICON         = 3
     REDIRECT_TO_CONFIG  = 4
+    GET_METRICS         = 5
+    GET_METRICS_JSON    = 6
 
     PATHS_FILES  = '/files'
+    PATHS_CACHE  = '/cache'
     PATHS_CONFIG = '/config'
+    PATHS_API    = '/api'
+    PATHS_API_LIBRARY = '/api/library'
+    PATHS_API_PLAYLISTS = '/api/playlists'
+    PATHS_API_BATCH = '/api/batch'
+    PATHS_API_CONFIG = '/api/config'
+    PATHS_API_STATUS = '/api/status'
+    PATHS_API_LOGGING = '/api/logging'
+    PATHS_API_EVENTS = '/api/events'
 
     PATHS_POST = {
         '/snooze'            : POST_SNOOZE,
@@ -107,186 +578,564 @@ class WebadminHandler(http.server.BaseHTTPRequestHandler):
         '/playlist_add_item' : POST_PLAYLIST_ADD_ITEM,
         '/playlist_remove_item' : POST_PLAYLIST_REMOVE_ITEM,
         '/playlist_delete' : POST_PLAYLIST_DELETE,
+        '/zone_set'        : POST_ZONE_SET,
+        '/zone_remove'     : POST_ZONE_REMOVE,
     }
 
     PATHS_GET = {
         '/stylesheet.css'       : GET_STYLESHEET,
         '/favicon.ico'          : GET_FAVICON,
+        '/metrics'              : GET_METRICS,
+        '/metrics.json'         : GET_METRICS_JSON,
         '/'                     : REDIRECT_TO_CONFIG
     }
 
+    # Connections are kept alive between requests, so every response carries its length
+    protocol_version = 'HTTP/1.1'
+    timeout = WEBADMIN_TIMEOUT
+    # Headers and body are separate writes, do not let the body wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
     logger = None
     config = None
+    journal = None
     state = None
+    scheduler = None
+    library = None
+    # zone name : (MPD endpoint, AudioWorker)
+    zone_audios = {}
     template_index = None
+    template_file_path = None
+    template_lock = threading.Lock()
+    render_cache = RenderCache()
     contents_stylesheet = None
     contents_favicon = None
 
     def log_message(self, format, *args):
-        self.logger.info(format, *args)
+        self.logger.debug(format, *args)
+
+    @classmethod
+    def get_template_index(cls):
+        # Compiled on first use, so jinja2 stays off the daemon startup
+        with cls.template_lock:
+            if cls.template_index == None:
+                cls.template_index = template_load(cls.logger, cls.template_file_path)
+        return cls.template_index
+
+    def get_metrics_route(self):
+        # Only known routes become labels, so clients can not grow the metrics without bound
+        route = '/' + urllib.parse.urlsplit(self.path).path.split('/')[1]
+        if not (route in self.PATHS_GET or route in self.PATHS_POST or route in (self.PATHS_FILES, self.PATHS_CACHE, self.PATHS_CONFIG, self.PATHS_API)):
+            route = 'other'
+        return self.command + ' ' + route
 
     def do_GET(self):
-        path = urllib.parse.unquote(self.path)
+        if urllib.parse.urlsplit(self.path).path == self.PATHS_API_EVENTS:
+            # Open for as long as the client listens, it would only skew the request durations
+            self.send_events()
+            return
+        with metrics.timer('clock_raspio_request_seconds', self.get_metrics_route()):
+            self.handle_get()
+
+    def send_events(self):
+        """Streams the status of a zone, of the zones given by several zone
+        parameters or of all of them with zone=*, as Server-Sent Events, until
+        the client leaves."""
+        zone_names = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('zone', [DEFAULT_ZONE_NAME])
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # A reconnecting client already has the status it saw last
+        (epoch, separator, version) = self.headers.get('Last-Event-ID', '').partition('-')
+        version = int(version) if epoch == status_channel.epoch and version.isdigit() else None
+        # zone name : status latest sent, all of them are sent again unless the client is up to date
+        (current_version, statuses) = status_channel.wait(None, 0)
+        sent = dict(statuses) if version == current_version else {}
+        if version != current_version: version = None
+        latest_write = time.time()
+        with status_channel.condition:
+            status_channel.listeners += 1
+        try:
+            while True:
+                (version, statuses) = status_channel.wait(version, STATUS_KEEPALIVE_PERIOD)
+                now = time.time()
+                for zone_name in sorted(statuses):
+                    status = statuses[zone_name]
+                    if not ('*' in zone_names or zone_name in zone_names) or sent.get(zone_name) == status: continue
+                    # Sent with the time, so the client can count the snooze down whatever its clock says
+                    data = json.dumps(dict(status, zone=zone_name, time=now))
+                    self.wfile.write('id: {0}-{1}\nevent: status\ndata: {2}\n\n'.format(status_channel.epoch, version, data).encode('utf-8'))
+                    sent[zone_name] = status
+                    latest_write = now
+                if now >= latest_write + STATUS_KEEPALIVE_PERIOD:
+                    # Also finds out when the client is gone
+                    self.wfile.write(b': keepalive\n\n')
+                    latest_write = now
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with status_channel.condition:
+                status_channel.listeners -= 1
+
+    def do_POST(self):
+        with metrics.timer('clock_raspio_request_seconds', self.get_metrics_route()):
+            self.handle_post()
+
+    def send_json(self, dct, code = 200):
+        contents = json.dumps(dct).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(contents)))
+        if self.close_connection: self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def read_json(self):
+        # Returns None if the body is missing or is not JSON
+        length = self.headers.get('content-length')
+        if length == None or not length.isdigit(): return None
+        try:
+            return json.loads(self.rfile.read(int(length)).decode('utf-8'))
+        except ValueError:
+            return None
+
+    def send_contents(self, content_type, contents):
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    @staticmethod
+    def get_query_int(query, name, default):
+        try: return int(query[name][0])
+        except (KeyError, ValueError): return default
+
+    def handle_get(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query)
         if path in self.PATHS_GET:
-            operation = self.PATHS_GET[self.path]
+            operation = self.PATHS_GET[path]
             if operation == self.GET_STYLESHEET and self.contents_stylesheet:
-                self.send_response(200)
-                self.send_header('Content-type', 'text/css')
-                self.end_headers()
-                self.wfile.write(self.contents_stylesheet)
-            if operation == self.GET_FAVICON and self.contents_favicon:
-                self.send_response(200)
-                self.send_header('Content-type', 'text/css')
-                self.end_headers()
-                self.wfile.write(self.contents_favicon)
+                self.send_contents('text/css', self.contents_stylesheet)
+            elif operation == self.GET_FAVICON and self.contents_favicon:
+                self.send_contents('image/x-icon', self.contents_favicon)
+            elif operation == self.GET_METRICS:
+                self.send_contents('text/plain; version=0.0.4', metrics.to_prometheus().encode('utf-8'))
+            elif operation == self.GET_METRICS_JSON:
+                self.send_contents('application/json', json.dumps(metrics.to_json()).encode('utf-8'))
             elif operation == self.REDIRECT_TO_CONFIG:
                 self.send_response(303)
                 self.send_header("Location", "/config")
+                self.send_header('Content-Length', '0')
                 self.end_headers()
             else:
                 self.send_error(404)
-                self.end_headers()
                
+        elif path == self.PATHS_API_LIBRARY:
+            offset = self.get_query_int(query, 'offset', 0)
+            limit = self.get_query_int(query, 'limit', LIBRARY_PAGE_SIZE)
+            (total, tracks) = self.library.search(query.get('q', [''])[0], offset, limit)
+            self.send_json({'total' : total, 'offset' : offset, 'tracks' : tracks})
+
+        elif path.startswith(self.PATHS_API_PLAYLISTS + '/'):
+            playlist_name = path[len(self.PATHS_API_PLAYLISTS)+1:]
+            offset = max(0, self.get_query_int(query, 'offset', 0))
+            limit = max(0, min(self.get_query_int(query, 'limit', CONFIG_PAGE_SIZE), CONFIG_MAX_PAGE_SIZE))
+            with self.state.lock:
+                playlist = self.config.playlists.get(playlist_name)
+                if playlist != None:
+                    total = len(playlist.items)
+                    items = playlist.items[offset:offset+limit]
+            if playlist == None:
+                self.send_error(404)
+                return
+            self.send_json({'name' : playlist_name, 'total' : total, 'offset' : offset, 'items' : items})
+
+        elif path == self.PATHS_API_CONFIG:
+            with self.state.lock:
+                dct = self.config.to_json()
+            dct['timezone'] = timezone_get()
+            self.send_json(dct)
+
+        elif path == self.PATHS_API_STATUS:
+            now = time.time()
+            zone_name = query.get('zone', [DEFAULT_ZONE_NAME])[0]
+            zone_audio = self.zone_audios.get(zone_name)
+            with self.state.lock:
+                if not zone_name in self.config.get_zone_names():
+                    self.send_error(404)
+                    return
+                zone = self.state.get_zone(zone_name)
+                dct = {}
+                dct['time'] = now
+                dct['timezone'] = timezone_get()
+                dct['zone'] = zone_name
+                dct['zone_names'] = self.config.get_zone_names()
+                dct['current_profile_name'] = self.config.get_zone_profile_name(zone_name)
+                dct['config_version'] = self.state.config_version
+                dct['journal_sequence'] = self.config.journal_sequence
+                dct['playing'] = zone.previous_timeslot_id != None
+                dct['volume'] = zone.previous_volume
+                dct['audio_queue_depth'] = zone_audio[1].get_depth() if zone_audio != None else 0
+                dct['snoozed'] = now < zone.latest_snooze_time + self.config.snooze_duration
+                next_timeslot = self.config.get_next_timeslot(now, zone_name)
+                dct['next_timeslot_begin'] = next_timeslot[0] if next_timeslot else None
+            self.send_json(dct)
+
+        elif path == self.PATHS_API_LOGGING:
+            self.send_json({'levels' : log_get_levels()})
+
         elif path.startswith(self.PATHS_CONFIG):        
             subpath = path[len(self.PATHS_CONFIG)+1:]
             path_params = subpath.split('/')
             params = {}
             for i in range(0, int(len(path_params)/2)): params[path_params[2*i]] = path_params[2*i+1]
+            for name in query: params[name] = query[name][0]
+            # Checked before reading the timezones, a page the browser already has costs no process
+            etag = self.render_cache.get_etag(self.state.config_version, timezone_cache.get_version(), self.library.version)
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            timezone_current = timezone_get()
+            timezones = timezone_list()
+            etag = self.render_cache.get_etag(self.state.config_version, timezone_cache.get_version(), self.library.version)
+            entry = self.render_cache.get(self.path, etag)
+            if entry == None:
+                # Long playlists, timetables and searches are rendered one page at a time
+                page_offset = max(0, self.get_query_int(query, 'offset', 0))
+                library_results = None
+                if 'library' in params:
+                    library_results = self.library.search(params.get('q', ''), page_offset, LIBRARY_PAGE_SIZE)
+                with self.state.lock:
+                    etag = self.render_cache.get_etag(self.state.config_version, timezone_cache.get_version(), self.library.version)
+                    rendered_text = self.get_template_index().render(
+                        display_update_button = DEVEL_MODE,
+                        default_zone_name = DEFAULT_ZONE_NAME,
+                        timezone_current = timezone_current,
+                        timezone_list = timezones,
+                        config = self.config,
+                        state = self.state,
+                        params = params,
+                        library_results = library_results,
+                        library_page_size = LIBRARY_PAGE_SIZE,
+                        page_offset = page_offset,
+                        page_size = CONFIG_PAGE_SIZE
+                        )
+                entry = self.render_cache.put(self.path, etag, rendered_text.encode('utf-8'))
+            (etag, body, body_gzip) = entry
+            use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+            if use_gzip: body = body_gzip
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Vary', 'Accept-Encoding')
+            if use_gzip: self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            rendered_text = self.template_index.render(
-                display_update_button = DEVEL_MODE,
-                timezone_current = timezone_get(),
-                timezone_list = timezone_list(),
-                config = self.config,
-                state = self.state,
-                params = params
-                )
-            self.wfile.write(rendered_text.encode('utf-8'))
+            self.wfile.write(body)
             
-        elif path.startswith(self.PATHS_FILES):        
-            subpath = path[len(self.PATHS_FILES)+1:]
-            filepath = FILES_FOLDER_PATH+subpath
+        elif path.startswith(self.PATHS_FILES) or path.startswith(self.PATHS_CACHE + '/'):
+            import mimetypes
+            # The media cache is read by MPD, which only plays local files from its own music folder
+            if path.startswith(self.PATHS_CACHE + '/'): filepath = self.get_path_in_folder(MEDIA_CACHE_FOLDER_PATH, path[len(self.PATHS_CACHE)+1:])
+            else: filepath = self.get_files_path(path)
             try:
-                with open(filepath, 'rb') as file:
-                    self.wfile.write( file.read() )                    
-                self.send_response(200)
-                self.end_headers()
-                self.log_message("Sent file %s",  filepath)
-            except:                 
+                if filepath == None: raise FileNotFoundError(path)
+                file = open(filepath, 'rb')
+            except OSError:
                 self.send_error(404)
+                return
+            with file:
+                size = os.fstat(file.fileno()).st_size
+                (offset, length) = (0, size)
+                byte_range = self.get_byte_range(size)
+                if byte_range == False:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if byte_range != None:
+                    (offset, length) = byte_range
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(offset, offset + length - 1, size))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-type', mimetypes.guess_type(filepath)[0] or 'application/octet-stream')
+                self.send_header('Content-Length', str(length))
+                self.send_header('Accept-Ranges', 'bytes')
                 self.end_headers()
-                pass
+                self.send_file(file, offset, length)
+            self.log_message("Sent file %s",  filepath)
         else:
             self.send_error(404)
-            self.end_headers()
+
+    @staticmethod
+    def get_path_in_folder(folder_path, relative_path):
+        # Returns None for paths escaping the folder
+        folder_path = os.path.normpath(folder_path)
+        filepath = os.path.normpath(os.path.join(folder_path, relative_path))
+        if not filepath.startswith(folder_path + os.sep): return None
+        return filepath
+
+    def get_files_path(self, path):
+        return self.get_path_in_folder(FILES_FOLDER_PATH, path[len(self.PATHS_FILES)+1:])
+
+    def get_byte_range(self, size):
+        """Returns (offset, length) for a single range Range header, None to
+        send the whole file, or False if the range can not be satisfied."""
+        header = self.headers.get('Range')
+        if header == None or not header.startswith('bytes=') or ',' in header: return None
+        (first, separator, last) = header[len('bytes='):].strip().partition('-')
+        try:
+            if first == '':
+                length = min(int(last), size)
+                if length <= 0: return False
+                return (size - length, length)
+            first = int(first)
+            last = int(last) if last != '' else size - 1
+        except ValueError:
+            return None
+        if first >= size or last < first: return False
+        last = min(last, size - 1)
+        return (first, last - first + 1)
+
+    def send_file(self, file, offset, length):
+        self.wfile.flush()
+        if length <= 0: return
+        # Zero-copy from the page cache to the socket where the system allows it, falls back to plain sends
+        # otherwise. Either way it waits for slow readers, MPD reads cached files at playback speed, up to
+        # the socket timeout.
+        self.connection.sendfile(file, offset, length)
+
+    def receive_file(self, filepath, length):
+        # Written aside then renamed, so the file is never seen half uploaded
+        (handle, temporary_path) = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.upload-')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                while length > 0:
+                    chunk = self.rfile.read(min(length, FILES_CHUNK_SIZE))
+                    if not chunk: raise ConnectionError('Upload interrupted')
+                    file.write(chunk)
+                    length -= len(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, filepath)
+        except:
+            os.unlink(temporary_path)
+            raise
 
     def get_post_var(self,  postvars,  name):
         if name in postvars and len(postvars[name]) > 0: return postvars[name][0].decode('utf-8')
         return ""
         
-    def do_POST(self):    
+    def apply_post(self, operation, postvars):
+        playlist_name = self.get_post_var(postvars, b'playlist_name')
+        profile_name = self.get_post_var(postvars, b'profile_name')
+        zone_name = self.get_post_var(postvars, b'zone_name') or DEFAULT_ZONE_NAME
+        
+        if operation == self.POST_SNOOZE and zone_name in self.config.get_zone_names():
+            self.state.get_zone(zone_name).snooze()
+        elif operation == self.POST_DISCARD and zone_name in self.config.get_zone_names():
+            self.state.get_zone(zone_name).discard()
+        elif operation == self.POST_UPDATE:
+            self.state.request_update()
+        elif operation == self.POST_SET_PROFILE and len(profile_name) > 0:
+            if self.change_config({'op' : 'set_profile', 'profile_name' : profile_name, 'zone_name' : zone_name}):
+                self.log_message("Switching profile of %s to %s", zone_name, profile_name)
+        elif operation == self.POST_ZONE_SET:
+            zone = {'profile_name' : profile_name, 'mpd_host' : self.get_post_var(postvars, b'mpd_host') or MPD_HOST}
+            mpd_port = self.get_post_var(postvars, b'mpd_port')
+            zone['mpd_port'] = int(mpd_port) if mpd_port.isdigit() else MPD_PORT
+            self.change_config({'op' : 'zone_set', 'zone_name' : zone_name, 'zone' : zone})
+        elif operation == self.POST_ZONE_REMOVE:
+            self.change_config({'op' : 'zone_remove', 'zone_name' : zone_name})
+        elif operation == self.POST_PLAYLIST_NEW  :
+            self.change_config({'op' : 'playlist_new', 'playlist_name' : playlist_name})
+        elif operation == self.POST_PLAYLIST_RENAME  :
+            playlist_new_name = self.get_post_var(postvars, b'playlist_new_name')
+            self.change_config({'op' : 'playlist_rename', 'playlist_name' : playlist_name, 'playlist_new_name' : playlist_new_name})
+        elif operation ==self. POST_PLAYLIST_ADD_ITEM :
+            item = self.get_post_var(postvars, b'item')
+            self.change_config({'op' : 'playlist_add_item', 'playlist_name' : playlist_name, 'item' : item})
+        elif operation == self.POST_PLAYLIST_REMOVE_ITEM   :
+            item = self.get_post_var(postvars, b'item')
+            self.change_config({'op' : 'playlist_remove_item', 'playlist_name' : playlist_name, 'item' : item})
+        elif operation == self.POST_PLAYLIST_DELETE  :
+            self.change_config({'op' : 'playlist_delete', 'playlist_name' : playlist_name})
+
+    def change_config(self, record):
+        if not config_change(self.config, self.journal, record): return False
+        self.state.request_config_save()
+        return True
+
+    def apply_api_post(self, path, dct):
+        """Applies a JSON request, returns (code, response)."""
+        if path == self.PATHS_API_LOGGING:
+            # Not part of the config, levels are back to LOG_LEVELS on restart
+            if not isinstance(dct, dict) or not isinstance(dct.get('levels'), dict): return (400, {'error' : 'Expected {"levels" : {...}}'})
+            try:
+                log_set_levels(dct['levels'])
+            except ValueError as e:
+                return (400, {'error' : '{0}'.format(e)})
+            self.logger.info('Logging : levels set to {0}'.format(dct['levels']))
+            return (200, {'levels' : log_get_levels()})
+        elif path == self.PATHS_API_BATCH:
+            if not isinstance(dct, dict) or not isinstance(dct.get('operations'), list): return (400, {'error' : 'Expected {"operations" : [...]}'})
+            record = {'op' : 'batch', 'operations' : dct['operations']}
+        elif path == self.PATHS_API_CONFIG:
+            if not isinstance(dct, dict): return (400, {'error' : 'Expected a config'})
+            timezone = dct.pop('timezone', None)
+            record = {'op' : 'import', 'config' : dct}
+        else:
+            return (404, {'error' : 'Unknown path'})
+
+        with self.state.lock:
+            try:
+                changed = self.change_config(record)
+                if not changed and record['op'] == 'batch':
+                    # Rejected as a whole, replay it on a copy to tell which operation failed
+                    position = config_apply_batch(config_copy(self.config), record['operations'])
+                    return (409, {'error' : 'Operation changed nothing or is invalid', 'position' : position})
+                if not changed and record['op'] == 'import':
+                    return (400, {'error' : 'Invalid config'})
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                return (400, {'error' : 'Invalid operation : {0}'.format(e)})
+            config_version = self.state.config_version
+        # Written once the scheduler can take the lock again
+        self.journal.flush()
+        if record['op'] == 'import' and timezone:
+            if not timezone_set(timezone):
+                self.logger.error('Could not set timezone %s', timezone)
+        return (200, {'config_version' : config_version})
+
+    def handle_post(self):
         path = urllib.parse.unquote(self.path)
-        if path in self.PATHS_POST:
+        if path.startswith(self.PATHS_API + '/'):
+            dct = self.read_json()
+            if dct == None:
+                self.close_connection = True
+                (code, response) = (400, {'error' : 'Expected a JSON body'})
+            else:
+                (code, response) = self.apply_api_post(path, dct)
+            if code == 200: self.scheduler.wake()
+            self.send_json(response, code)
+        elif path in self.PATHS_POST:
             operation = self.PATHS_POST[path]
-            ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
+            ctype = self.headers.get_content_type()
             postvars = {}
             if ctype == 'multipart/form-data':
-                postvars = cgi.parse_multipart(self.rfile, pdict)
+                # Only imported for the rare forms sending files, cgi is slow to import
+                import cgi
+                ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
+                pdict['boundary'] = pdict['boundary'].encode('utf-8')
+                pdict['CONTENT-LENGTH'] = self.headers.get('content-length')
+                fields = cgi.parse_multipart(self.rfile, pdict)
+                for name in fields:
+                    postvars[name.encode('utf-8')] = [value if isinstance(value, bytes) else value.encode('utf-8') for value in fields[name]]
             elif ctype == 'application/x-www-form-urlencoded':
                 length = int(self.headers.get('content-length'))
-                postvars = cgi.parse_qs(self.rfile.read(length), keep_blank_values=1)
+                postvars = urllib.parse.parse_qs(self.rfile.read(length), keep_blank_values=True)
+            else:
+                # The body was not read, it can not be told apart from the next request
+                self.close_connection = True
 
-            playlist_name = self.get_post_var(postvars, b'playlist_name')
-            profile_name = self.get_post_var(postvars, b'profile_name')
             timezone = self.get_post_var(postvars, b'timezone')
-            
-            if operation == self.POST_SNOOZE:
-                self.state.snooze()
-            elif operation == self.POST_DISCARD:
-                self.state.discard()
-            elif operation == self.POST_UPDATE:
-                self.state.request_update()
-            elif operation == self.POST_SET_TIMEZONE and len(timezone) > 0:
-                self.log_message("Setting timezone")
-                timezone_set(timezone)
-            elif operation == self.POST_SET_PROFILE and len(profile_name) > 0:
-                if profile_name in self.config.profiles:
-                    self.log_message("Switching profile to %s", profile_name)
-                    self.config.current_profile_name = profile_name
-                    self.state.config_save_requested = True
-                    
-            elif operation == self.POST_PLAYLIST_NEW  :
-                if not playlist_name in self.config.playlists :
-                    self.config.playlists[playlist_name] = ConfigPlaylist()
-                    self.state.config_save_requested = True
-                
-            elif operation == self.POST_PLAYLIST_RENAME  :
-                playlist_new_name = self.get_post_var(postvars, b'playlist_new_name')
-                self.config.playlists[playlist_new_name] = self.config.playlists.pop(playlist_name)
-                self.state.config_save_requested = True
-            
-            elif operation ==self. POST_PLAYLIST_ADD_ITEM :
-                item = self.get_post_var(postvars, b'item')
-                self.config.playlists[playlist_name].items.append(item)
-                self.state.config_save_requested = True
-                
-            elif operation == self.POST_PLAYLIST_REMOVE_ITEM   :
-                item = self.get_post_var(postvars, b'item')
-                self.config.playlists[playlist_name].items.remove(item)
-                self.state.config_save_requested = True
-                
-            elif operation == self.POST_PLAYLIST_DELETE  :
-                self.config.playlists.pop(playlist_name)
-                self.state.config_save_requested = True
-    
+            if operation == self.POST_SET_TIMEZONE:
+                if len(timezone) > 0:
+                    self.log_message("Setting timezone")
+                    if not timezone_set(timezone):
+                        self.logger.error('Could not set timezone %s', timezone)
+            else:
+                with self.state.lock:
+                    self.apply_post(operation, postvars)
+                self.journal.flush()
+            self.scheduler.wake()
+
+            # Forms may ask to come back to the page they were posted from
+            location = self.get_post_var(postvars, b'return_to')
+            if not location.startswith(self.PATHS_CONFIG): location = self.PATHS_CONFIG
             self.send_response(303)
-            self.send_header("Location", "/config")
+            self.send_header("Location", urllib.parse.quote(location, safe='/?&=%'))
+            self.send_header('Content-Length', '0')
+            if self.close_connection: self.send_header('Connection', 'close')
             self.end_headers()
         elif path.startswith(self.PATHS_FILES):
-            subpath = path[len(self.PATHS_FILES)+1:]
-            filepath = FILES_FOLDER_PATH+subpath
-            try:
-                with open(filepath, 'wb') as file:
-                    file.write( self.rfile.read() )                  
-                self.send_response(200)
-                self.end_headers()
-                self.log_message("Recieved file %s",  filepath)
-            except:                 
-                self.send_error(500)
-                self.end_headers()
-                pass
+            filepath = self.get_files_path(path)
+            length = self.headers.get('content-length')
+            if filepath == None:
+                self.close_connection = True
+                self.send_error(404)
+            elif length == None or not length.isdigit():
+                self.close_connection = True
+                self.send_error(411)
+            elif int(length) > FILES_MAX_UPLOAD_SIZE:
+                self.close_connection = True
+                self.send_error(413)
+            else:
+                try:
+                    self.receive_file(filepath, int(length))
+                    self.send_response(200)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    self.log_message("Recieved file %s",  filepath)
+                    self.library.request_refresh()
+                    self.scheduler.wake()
+                except OSError:
+                    self.logger.error('Could not receive file %s', filepath, exc_info=True)
+                    self.close_connection = True
+                    self.send_error(500)
         else:
+            self.close_connection = True
             self.send_error(404)
-            self.end_headers()
 
 class ConfigTimeslot:
+    """Immutable once built, a change is a new timeslot replacing the old one
+    in its timetable, which then invalidates its index."""
+    __slots__ = ('begin_hour', 'begin_minute', 'begin_day', 'duration', 'fade_in_duration', 'fade_in_curve', 'playlist_name', 'id')
+
+    FADE_LINEAR      = 1
+    FADE_LOGARITHMIC = 2
+    FADE_PERCEPTUAL  = 3
+
     def __init__(self, set_sensible_default = False):
-        self.begin_hour       = 0
-        self.begin_minute     = 0
-        self.begin_day        = 0
-        self.duration         = 3600
-        self.fade_in_duration = 600
-        self.playlist_name    = ''
+        self.set_values(0, 0, 0, 3600, 600, self.FADE_LINEAR, '')
 
         if set_sensible_default:
-            self.begin_hour       = 7
-            self.begin_minute     = 15
-            self.begin_day        = 0
-            self.duration         = 3600
-            self.fade_in_duration = 600
-            self.playlist_name    = 'Default playlist'
+            self.set_values(7, 15, 0, 3600, 600, self.FADE_LINEAR, 'Default playlist')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ConfigTimeslot is immutable, build a new one with from_json')
+
+    def set_values(self, begin_hour, begin_minute, begin_day, duration, fade_in_duration, fade_in_curve, playlist_name):
+        # Only while building the timeslot, in __init__ and from_json
+        object.__setattr__(self, 'begin_hour', begin_hour)
+        object.__setattr__(self, 'begin_minute', begin_minute)
+        object.__setattr__(self, 'begin_day', begin_day)
+        object.__setattr__(self, 'duration', duration)
+        object.__setattr__(self, 'fade_in_duration', fade_in_duration)
+        object.__setattr__(self, 'fade_in_curve', fade_in_curve)
+        object.__setattr__(self, 'playlist_name', playlist_name)
+        # Built from the values, so an identical timeslot keeps its id across config reloads
+        object.__setattr__(self, 'id', (begin_hour, begin_minute, begin_day, duration, fade_in_duration, fade_in_curve, playlist_name))
 
     def get_id(self):
-        m = hashlib.md5()
-        m.update('{0}'.format(self.begin_hour)      .encode('utf-8'))
-        m.update('{0}'.format(self.begin_minute)    .encode('utf-8'))
-        m.update('{0}'.format(self.begin_day)       .encode('utf-8'))
-        m.update('{0}'.format(self.duration)        .encode('utf-8'))
-        m.update('{0}'.format(self.fade_in_duration).encode('utf-8'))
-        m.update(self.playlist_name.encode('utf-8'))
-        return m.digest()
+        return self.id
+
+    def is_valid(self):
+        for value in (self.begin_hour, self.begin_minute, self.begin_day, self.duration, self.fade_in_duration):
+            if not isinstance(value, int) or isinstance(value, bool): return False
+        return (0 <= self.begin_hour < 24 and 0 <= self.begin_minute < 60 and self.begin_day >= 0
+            and self.duration > 0 and self.fade_in_duration >= 0 and isinstance(self.playlist_name, str))
 
     def to_json(self):
         dct = {}
@@ -295,16 +1144,117 @@ class ConfigTimeslot:
         dct['begin_day']        = self.begin_day
         dct['duration']         = self.duration
         dct['fade_in_duration'] = self.fade_in_duration
+        if   self.fade_in_curve == self.FADE_LINEAR:      dct['fade_in_curve'] = 'FADE_LINEAR'
+        elif self.fade_in_curve == self.FADE_LOGARITHMIC: dct['fade_in_curve'] = 'FADE_LOGARITHMIC'
+        elif self.fade_in_curve == self.FADE_PERCEPTUAL:  dct['fade_in_curve'] = 'FADE_PERCEPTUAL'
         dct['playlist_name']    = self.playlist_name
         return dct
 
     def from_json(self, dct):
-        self.begin_hour        = dct['begin_hour']
-        self.begin_minute      = dct['begin_minute']
-        self.begin_day         = dct['begin_day']
-        self.duration          = dct['duration']
-        self.fade_in_duration  = dct['fade_in_duration']
-        self.playlist_name     = dct['playlist_name']
+        fade_in_curve = self.fade_in_curve
+        if 'fade_in_curve' in dct:
+            if   dct['fade_in_curve'] == 'FADE_LINEAR':      fade_in_curve = self.FADE_LINEAR
+            elif dct['fade_in_curve'] == 'FADE_LOGARITHMIC': fade_in_curve = self.FADE_LOGARITHMIC
+            elif dct['fade_in_curve'] == 'FADE_PERCEPTUAL':  fade_in_curve = self.FADE_PERCEPTUAL
+        self.set_values(dct['begin_hour'], dct['begin_minute'], dct['begin_day'], dct['duration'], dct['fade_in_duration'], fade_in_curve, dct['playlist_name'])
+
+class FadePlan:
+    """Volume changes making up a fade-in, planned once for a duration and a
+    curve: one change each time the curve gains FADE_VOLUME_RESOLUTION
+    percent, but no closer than FADE_MIN_STEP_PERIOD seconds apart."""
+
+    def __init__(self, duration, curve, resolution = FADE_VOLUME_RESOLUTION, min_step_period = FADE_MIN_STEP_PERIOD):
+        self.offsets = [0.]
+        self.volumes = [0]
+        if duration <= 0:
+            self.volumes = [100]
+            return
+        levels = list(range(resolution, 100, resolution)) + [100]
+        for level in levels:
+            offset = duration * self.get_progress(curve, level / 100.)
+            # With some slack, changes exactly min_step_period apart would otherwise be dropped to rounding
+            if offset - self.offsets[-1] < min_step_period - 1e-9:
+                if level < 100: continue
+                # Always end on full volume, in place of the previous change if it is too close
+                if len(self.offsets) > 1:
+                    self.offsets.pop()
+                    self.volumes.pop()
+            self.offsets.append(offset)
+            self.volumes.append(level)
+
+    @staticmethod
+    def get_progress(curve, volume):
+        # Inverse of the curves, the part of the fade elapsed when the volume is reached
+        if curve == ConfigTimeslot.FADE_LOGARITHMIC:
+            # volume = log10(1 + 9*progress), loud quickly then slowly to full
+            return (math.pow(10., volume) - 1.) / 9.
+        if curve == ConfigTimeslot.FADE_PERCEPTUAL:
+            # volume = progress^3, MPD volumes scale the amplitude and the ear hears it logarithmically
+            return math.pow(volume, 1. / 3.)
+        return volume
+
+    def get_volume(self, elapsed):
+        position = bisect.bisect_right(self.offsets, elapsed) - 1
+        return self.volumes[max(position, 0)]
+
+    def get_next_offset(self, elapsed):
+        position = bisect.bisect_right(self.offsets, elapsed)
+        if position < len(self.offsets): return self.offsets[position]
+        return None
+
+@functools.lru_cache(maxsize=16)
+def fade_plan_get(duration, curve):
+    return FadePlan(duration, curve)
+
+class ConfigTimetableIndex:
+    """Timeslots sorted by their begin, in seconds relative to the start of
+    the period, so lookups are a bisection instead of a scan."""
+
+    DAY_S = 24*3600
+
+    def __init__(self, timetable):
+        self.period = timetable.period
+        entries = []
+        for (order, timeslot) in enumerate(timetable.timeslots):
+            timeslot_begin_s = (timeslot.begin_hour *3600 + timeslot.begin_minute * 60)
+            # Timeslots do not overflow on the next day
+            timeslot_end_s = min(timeslot_begin_s + timeslot.duration, self.DAY_S)
+            if timeslot_begin_s >= timeslot_end_s: continue
+            day_s = timeslot.begin_day * self.DAY_S
+            entries.append((day_s + max(timeslot_begin_s, 0), day_s + timeslot_end_s, order, timeslot_begin_s, timeslot))
+        entries.sort(key = lambda entry: (entry[0], entry[2]))
+        self.begins    = [entry[0] for entry in entries]
+        self.ends      = [entry[1] for entry in entries]
+        self.orders    = [entry[2] for entry in entries]
+        self.begins_s  = [entry[3] for entry in entries]
+        self.timeslots = [entry[4] for entry in entries]
+        # Greatest end among the timeslots begining before each one, to stop scanning back early
+        self.max_ends = []
+        max_end = None
+        for end in self.ends:
+            if max_end == None or end > max_end: max_end = end
+            self.max_ends.append(max_end)
+
+    def find(self, current_day, current_s):
+        """Returns the position of the timeslot containing the instant, the
+        first one in timetable order if several overlap, or None."""
+        key = current_day * self.DAY_S + current_s
+        found = None
+        position = bisect.bisect_right(self.begins, key) - 1
+        while position >= 0 and self.max_ends[position] > key:
+            if self.ends[position] > key and (found == None or self.orders[position] < self.orders[found]):
+                found = position
+            position -= 1
+        return found
+
+    def find_next(self, current_day, after_s):
+        """Returns the position of the first timeslot of the day begining
+        after after_s, in seconds since midnight, or None."""
+        day_s = current_day * self.DAY_S
+        position = bisect.bisect_right(self.begins, day_s + after_s)
+        if position < len(self.begins) and self.begins[position] < day_s + self.DAY_S:
+            return position
+        return None
 
 class ConfigTimetable:
     PERIOD_ONEDAY = 1
@@ -314,6 +1264,7 @@ class ConfigTimetable:
     def __init__(self, set_sensible_default = False):
         self.period = self.PERIOD_ONEDAY
         self.timeslots = []
+        self.index = None
         if set_sensible_default:
             self.timeslots.append( ConfigTimeslot(set_sensible_default = set_sensible_default) )
 
@@ -341,26 +1292,63 @@ class ConfigTimetable:
                 timeslot = ConfigTimeslot()
                 timeslot.from_json(dct_timeslot)
                 self.timeslots.append(timeslot)
+        self.invalidate_index()
+
+    def is_valid(self):
+        for timeslot in self.timeslots:
+            if not timeslot.is_valid(): return False
+        return True
+
+    def invalidate_index(self):
+        self.index = None
+
+    def get_index(self):
+        if self.index == None or self.index.period != self.period:
+            self.index = ConfigTimetableIndex(self)
+        return self.index
+
+    def get_day_index(self, date):
+        (isoyear, isoweek, isoday) = date.isocalendar()
+        if   self.period == self.PERIOD_ONEDAY:   return 0
+        elif self.period == self.PERIOD_ONEWEEK:  return (isoday - 1)
+        elif self.period == self.PERIOD_TWOWEEKS: return (isoday - 1) + (((isoweek-1)%2)*7)
+        elif self.period == self.PERIOD_ONEMONTH: return date.day
+        return 0
 
     def get_current_timeslot(self, now):
         nowdt = datetime.datetime.fromtimestamp(now)
-        current_day = 0
-        (isoyear, isoweek, isoday) = nowdt.date().isocalendar()
-        if   self.period == self.PERIOD_ONEDAY:   current_day = 0
-        elif self.period == self.PERIOD_ONEWEEK:  current_day = (isoday - 1)
-        elif self.period == self.PERIOD_TWOWEEKS: current_day = (isoday - 1) + (((isoweek-1)%2)*7)
-        elif self.period == self.PERIOD_ONEMONTH: current_day = nowdt.date().day
-        current_s = nowdt.hour * 3600 + nowdt.minute *60 + nowdt.second
+        current_day = self.get_day_index(nowdt.date())
+        # Sub-second precision, the fade plan may change the volume several times per second
+        current_s = nowdt.hour * 3600 + nowdt.minute *60 + nowdt.second + nowdt.microsecond / 1000000.
         #print( "{0} : {1} : {2} : {3}".format(current_day, nowdt.hour, nowdt.minute, nowdt.second))
-        for timeslot in self.timeslots:
-            matches_day = timeslot.begin_day == current_day
-            timeslot_begin_s = (timeslot.begin_hour *3600 + timeslot.begin_minute * 60)
-            matches_s = timeslot_begin_s <= current_s and current_s < timeslot_begin_s + timeslot.duration
-            if( matches_day and matches_s ):
-                fade_in_percent = (current_s - timeslot_begin_s) / (timeslot.fade_in_duration)
-                if fade_in_percent >= 1. : fade_in_percent = 1.
-                duration_percent = (current_s - timeslot_begin_s) / (timeslot.duration)
-                return (timeslot, duration_percent, fade_in_percent)
+        index = self.get_index()
+        position = index.find(current_day, current_s)
+        if position == None:
+            return None
+        timeslot = index.timeslots[position]
+        timeslot_begin_s = index.begins_s[position]
+        fade_in_percent = 1.
+        if timeslot.fade_in_duration > 0:
+            fade_in_percent = (current_s - timeslot_begin_s) / (timeslot.fade_in_duration)
+        if fade_in_percent >= 1. : fade_in_percent = 1.
+        duration_percent = (current_s - timeslot_begin_s) / (timeslot.duration)
+        return (timeslot, duration_percent, fade_in_percent)
+
+    def get_next_timeslot(self, now):
+        """Returns (begin time, timeslot) for the next timeslot to begin, or None."""
+        # A month is the longest period, so any timeslot begins within the next 32 days
+        nowdt = datetime.datetime.fromtimestamp(now)
+        index = self.get_index()
+        after_s = nowdt.hour * 3600 + nowdt.minute *60 + nowdt.second
+        for day_offset in range(0, 32):
+            date = nowdt.date() + datetime.timedelta(days=day_offset)
+            current_day = self.get_day_index(date)
+            position = index.find_next(current_day, after_s)
+            if position != None:
+                timeslot_begin_s = index.begins[position] - current_day * index.DAY_S
+                midnight = datetime.datetime.combine(date, datetime.time())
+                return ((midnight + datetime.timedelta(seconds=timeslot_begin_s)).timestamp(), index.timeslots[position])
+            after_s = -1
         return None
 
 class ConfigProfile:
@@ -377,15 +1365,26 @@ class ConfigProfile:
             self.timetable = ConfigTimetable()
             self.timetable.from_json(dct['timetable'])
 
+    def is_valid(self):
+        return self.timetable.is_valid()
+
     def get_current_timeslot(self, now):
         return self.timetable.get_current_timeslot(now)
 
+    def get_next_timeslot(self, now):
+        return self.timetable.get_next_timeslot(now)
+
 class ConfigPlaylist:
     def __init__(self, set_sensible_default = False):
         self.items = []
         if set_sensible_default:
             self.items.append(EXAMPLE_FILE_NAME)
 
+    def copy(self):
+        playlist = ConfigPlaylist()
+        playlist.items = list(self.items)
+        return playlist
+
     def to_json(self):
         dct = {}
         dct['items'] = []
@@ -399,12 +1398,49 @@ class ConfigPlaylist:
             for dct_item in dct_items:
                 self.items.append(dct_item)
 
+    def is_valid(self):
+        for item in self.items:
+            if not isinstance(item, str): return False
+        return True
+
+class ConfigZone:
+    """A room with its own MPD, following its own profile."""
+
+    def __init__(self):
+        self.profile_name = ''
+        self.mpd_host = MPD_HOST
+        self.mpd_port = MPD_PORT
+
+    def to_json(self):
+        dct = {}
+        dct['profile_name'] = self.profile_name
+        dct['mpd_host'] = self.mpd_host
+        dct['mpd_port'] = self.mpd_port
+        return dct
+
+    def from_json(self, dct):
+        if 'profile_name' in dct:
+            self.profile_name = dct['profile_name']
+        if 'mpd_host' in dct:
+            self.mpd_host = dct['mpd_host']
+        if 'mpd_port' in dct:
+            self.mpd_port = int(dct['mpd_port'])
+
+    def is_valid(self):
+        return isinstance(self.profile_name, str) and isinstance(self.mpd_host, str) and len(self.mpd_host) > 0 and 0 < self.mpd_port < 65536
+
 class Config:
     def __init__(self, set_sensible_default = False):
         self.profiles = {}
+        # zone name : ConfigZone, besides the default zone
+        self.zones = {}
         self.current_profile_name = ''
         self.playlists = {}
         self.snooze_duration = 5*60
+        # Sequence number of the latest journal record applied to this config
+        self.journal_sequence = 0
+        # Format of the file the config was read from, 0 if it was not read from a file
+        self.format_version = 0
 
         if set_sensible_default:
             profile_work = ConfigProfile(set_sensible_default = set_sensible_default)
@@ -422,12 +1458,17 @@ class Config:
         dct = {}
         dct['current_profile_name'] = self.current_profile_name
         dct['snooze_duration'] = self.snooze_duration
+        dct['journal_sequence'] = self.journal_sequence
+        dct['format_version'] = CONFIG_FORMAT_VERSION
         dct['profiles'] = {}
         for profile_name in self.profiles:
             dct['profiles'][profile_name] = self.profiles[profile_name].to_json()
         dct['playlists'] = {}
         for playlist_name in self.playlists:
             dct['playlists'][playlist_name] = self.playlists[playlist_name].to_json()
+        dct['zones'] = {}
+        for zone_name in self.zones:
+            dct['zones'][zone_name] = self.zones[zone_name].to_json()
 
         return dct
 
@@ -438,6 +1479,12 @@ class Config:
         if 'snooze_duration' in dct:
             self.snooze_duration = int(dct['snooze_duration'])
 
+        if 'journal_sequence' in dct:
+            self.journal_sequence = int(dct['journal_sequence'])
+
+        if 'format_version' in dct:
+            self.format_version = int(dct['format_version'])
+
         if 'profiles' in dct:
             dct_profiles = dct['profiles']
             for dct_profile in dct_profiles:
@@ -452,18 +1499,69 @@ class Config:
                 playlist.from_json(dct_playlists[dct_playlist])
                 self.playlists[dct_playlist] = playlist
 
-    def get_current_timeslot(self, now):
-        if not self.current_profile_name in self.profiles:
+        if 'zones' in dct:
+            dct_zones = dct['zones']
+            for dct_zone in dct_zones:
+                zone = ConfigZone()
+                zone.from_json(dct_zones[dct_zone])
+                self.zones[dct_zone] = zone
+
+    def is_valid(self):
+        """Whether the scheduler and the web admin can run on this config."""
+        if not self.current_profile_name in self.profiles: return False
+        # Saved as JSON object keys
+        for name in list(self.profiles) + list(self.playlists) + list(self.zones):
+            if not isinstance(name, str): return False
+        for profile_name in self.profiles:
+            if not self.profiles[profile_name].is_valid(): return False
+        for playlist_name in self.playlists:
+            if not self.playlists[playlist_name].is_valid(): return False
+        for zone_name in self.zones:
+            if not self.zones[zone_name].is_valid() or not self.zones[zone_name].profile_name in self.profiles: return False
+        return True
+
+    def get_zone_names(self):
+        return [DEFAULT_ZONE_NAME] + sorted(self.zones)
+
+    def get_zone_profile_name(self, zone_name):
+        if zone_name == DEFAULT_ZONE_NAME: return self.current_profile_name
+        if not zone_name in self.zones: return None
+        return self.zones[zone_name].profile_name
+
+    def get_zone_endpoint(self, zone_name):
+        # Read at call time, the default MPD port is set from the command line
+        if zone_name == DEFAULT_ZONE_NAME: return (MPD_HOST, MPD_PORT)
+        return (self.zones[zone_name].mpd_host, self.zones[zone_name].mpd_port)
+
+    def get_current_timeslot(self, now, zone_name = DEFAULT_ZONE_NAME):
+        profile_name = self.get_zone_profile_name(zone_name)
+        if not profile_name in self.profiles:
             return None
 
-        current_profile = self.profiles[self.current_profile_name]
+        current_profile = self.profiles[profile_name]
         return current_profile.get_current_timeslot(now)
 
+    def get_next_timeslot(self, now, zone_name = DEFAULT_ZONE_NAME):
+        profile_name = self.get_zone_profile_name(zone_name)
+        if not profile_name in self.profiles:
+            return None
+
+        current_profile = self.profiles[profile_name]
+        return current_profile.get_next_timeslot(now)
+
     def get_playlist_from_timeslot(self, timeslot):
         if not timeslot.playlist_name in self.playlists:
             return None
         return self.playlists[timeslot.playlist_name]
 
+    def assign(self, other):
+        # The config object is shared with the web admin, so its contents are replaced in place
+        self.profiles = other.profiles
+        self.current_profile_name = other.current_profile_name
+        self.playlists = other.playlists
+        self.zones = other.zones
+        self.snooze_duration = other.snooze_duration
+
 class ConfigDecoder:
     def __call__(self, dct):
         config = Config()
@@ -483,7 +1581,9 @@ def config_load(logger, path):
         with open(path, "r") as file:
             config_decoder = ConfigDecoder()
             dct = json.load(file)
-            return config_decoder(dct)
+            config = config_decoder(dct)
+            if not config.is_valid(): raise ValueError('Invalid config')
+            return config
     except:
         logger.debug('An error occured while trying to read the config file', exc_info=True)
         # backup file
@@ -493,56 +1593,1038 @@ def config_load(logger, path):
 
 
 def config_save(logger, path, config):
+    with metrics.timer('clock_raspio_config_save_seconds'):
+        config_write(path, config)
     logger.info('Config saved to %s', path)
-    with open(path, "w") as file:
-        config_encoder = ConfigEncoder()
-        dct = config_encoder(config)
-        json.dump(dct, file, sort_keys=True, indent=4, separators=(',', ': '))
 
-def audio_set_volume(logger, percent):
-    logger.info('Audio : set volume at {0}'.format(percent))
+def config_compact(logger, path, config, journal):
+    """Saves the config then empties the journal, returns False if the config
+    could not be saved, the journal is then kept."""
+    try:
+        config_save(logger, path, config)
+    except Exception:
+        logger.error('Could not save config to %s', path, exc_info=True)
+        return False
+    journal.reset()
+    return True
+
+def config_write(path, config):
+    # Written aside then renamed, so a power cut leaves either the old or the new file
+    folder_path = os.path.dirname(path) or '.'
+    (handle, temporary_path) = tempfile.mkstemp(dir=folder_path, prefix='.config-')
+    try:
+        with os.fdopen(handle, "w") as file:
+            config_encoder = ConfigEncoder()
+            dct = config_encoder(config)
+            json.dump(dct, file, sort_keys=True, indent=4, separators=(',', ': '))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except:
+        os.unlink(temporary_path)
+        raise
+    if os.name != 'nt':
+        folder = os.open(folder_path, os.O_RDONLY)
+        try: os.fsync(folder)
+        finally: os.close(folder)
+
+def config_copy(config):
+    copy = Config()
+    copy.from_json(config.to_json())
+    # Same timeslots, the compiled indexes stay valid until config_apply changes a timetable
+    for profile_name in copy.profiles:
+        copy.profiles[profile_name].timetable.index = config.profiles[profile_name].timetable.index
+    return copy
+
+def config_get_timetable(config, record):
+    profile_name = record.get('profile_name', config.current_profile_name)
+    if not profile_name in config.profiles: return None
+    return config.profiles[profile_name].timetable
+
+def config_apply_batch(config, records):
+    """Applies all the records or none of them, returns None on success or
+    the position of the first record that changed nothing."""
+    scratch = config_copy(config)
+    for (position, record) in enumerate(records):
+        if not config_apply(scratch, record): return position
+    config.assign(scratch)
+    return None
+
+def config_is_name(name):
+    # Names are JSON object keys, anything but a string can not be saved
+    return isinstance(name, str) and len(name) > 0
+
+def config_apply(config, record):
+    """Applies a change record to the config, returns False if it changed nothing."""
+    operation = record.get('op')
+    playlist_name = record.get('playlist_name', '')
+    if operation == 'set_profile':
+        if not record['profile_name'] in config.profiles: return False
+        zone_name = record.get('zone_name', DEFAULT_ZONE_NAME)
+        if zone_name == DEFAULT_ZONE_NAME: config.current_profile_name = record['profile_name']
+        elif zone_name in config.zones: config.zones[zone_name].profile_name = record['profile_name']
+        else: return False
+    elif operation == 'playlist_new':
+        if not config_is_name(playlist_name) or playlist_name in config.playlists: return False
+        config.playlists[playlist_name] = ConfigPlaylist()
+    elif operation == 'playlist_rename':
+        playlist_new_name = record['playlist_new_name']
+        if not playlist_name in config.playlists: return False
+        # Renaming onto another playlist would silently drop it
+        if not config_is_name(playlist_new_name) or playlist_new_name in config.playlists: return False
+        config.playlists[playlist_new_name] = config.playlists.pop(playlist_name)
+    elif operation == 'playlist_add_item':
+        if not playlist_name in config.playlists or not isinstance(record['item'], str): return False
+        config.playlists[playlist_name].items.append(record['item'])
+    elif operation == 'playlist_remove_item':
+        if not playlist_name in config.playlists or not isinstance(record['item'], str): return False
+        if not record['item'] in config.playlists[playlist_name].items: return False
+        config.playlists[playlist_name].items.remove(record['item'])
+    elif operation == 'playlist_delete':
+        if not playlist_name in config.playlists: return False
+        config.playlists.pop(playlist_name)
+    elif operation == 'playlist_move_item':
+        if not playlist_name in config.playlists: return False
+        items = config.playlists[playlist_name].items
+        if not (0 <= record['from'] < len(items) and 0 <= record['to'] < len(items)): return False
+        items.insert(record['to'], items.pop(record['from']))
+    elif operation == 'playlist_set_items':
+        if not playlist_name in config.playlists: return False
+        for item in record['items']:
+            if not isinstance(item, str): return False
+        config.playlists[playlist_name].items = list(record['items'])
+    elif operation == 'timeslot_add':
+        timetable = config_get_timetable(config, record)
+        if timetable == None: return False
+        timeslot = ConfigTimeslot()
+        timeslot.from_json(record['timeslot'])
+        if not timeslot.is_valid(): return False
+        timetable.timeslots.append(timeslot)
+        timetable.invalidate_index()
+    elif operation == 'timeslot_edit':
+        timetable = config_get_timetable(config, record)
+        if timetable == None or not 0 <= record['index'] < len(timetable.timeslots): return False
+        # Fields left out keep their value
+        timeslot = ConfigTimeslot()
+        dct = timetable.timeslots[record['index']].to_json()
+        dct.update(record['timeslot'])
+        timeslot.from_json(dct)
+        if not timeslot.is_valid(): return False
+        timetable.timeslots[record['index']] = timeslot
+        timetable.invalidate_index()
+    elif operation == 'timeslot_remove':
+        timetable = config_get_timetable(config, record)
+        if timetable == None or not 0 <= record['index'] < len(timetable.timeslots): return False
+        timetable.timeslots.pop(record['index'])
+        timetable.invalidate_index()
+    elif operation == 'zone_set':
+        zone_name = record['zone_name']
+        if not config_is_name(zone_name) or zone_name == DEFAULT_ZONE_NAME or '*' in zone_name: return False
+        # Fields left out keep their value
+        zone = ConfigZone()
+        if zone_name in config.zones: zone.from_json(config.zones[zone_name].to_json())
+        zone.from_json(record['zone'])
+        if not zone.is_valid() or not zone.profile_name in config.profiles: return False
+        config.zones[zone_name] = zone
+    elif operation == 'zone_remove':
+        if not record['zone_name'] in config.zones: return False
+        config.zones.pop(record['zone_name'])
+    elif operation == 'batch':
+        if config_apply_batch(config, record['operations']) != None: return False
+    elif operation == 'import':
+        imported = Config()
+        imported.from_json(record['config'])
+        # Checked before it is journaled, a config the scheduler can not run would be replayed on every start
+        if not imported.is_valid(): return False
+        # Zones are per device, a config pushed to a fleet leaves them out
+        if not 'zones' in record['config']: imported.zones = config.zones
+        config.assign(imported)
+    else:
+        return False
+    if 'seq' in record: config.journal_sequence = record['seq']
+    return True
+
+class ConfigJournal:
+    """Append-only log of the changes made to the config since the config
+    file was last written. Each record is a JSON line with a sequence number,
+    the config file stores the number of the latest record it includes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sequence = 0
+        self.records = 0
+        # Records appended under the config lock, written by flush() once it is released
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def replay(self, logger, config):
+        self.sequence = config.journal_sequence
+        self.records = 0
+        if not os.path.isfile(self.path): return
+        replayed = 0
+        with open(self.path, "r+b") as file:
+            valid_length = 0
+            for line in file:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Record cut by a power loss, drop it so the next appends start on a clean line
+                    logger.error('Ignoring truncated config journal record')
+                    file.truncate(valid_length)
+                    break
+                valid_length += len(line)
+                self.records += 1
+                if not isinstance(record, dict) or not isinstance(record.get('seq'), int):
+                    logger.error('Ignoring invalid config journal record %s', line.strip())
+                    continue
+                if record['seq'] <= config.journal_sequence: continue
+                # Applied to a copy, a record leaving a config that can not run or be saved is dropped
+                try:
+                    scratch = config_copy(config)
+                    config_apply(scratch, record)
+                    if not scratch.is_valid(): raise ValueError('Invalid config')
+                    config.assign(scratch)
+                except Exception as e:
+                    logger.error('Ignoring invalid config journal record %s : %s', line.strip(), e)
+                config.journal_sequence = record['seq']
+                self.sequence = record['seq']
+                replayed += 1
+        logger.info('Config journal : {0} records replayed'.format(replayed))
+
+    def append(self, record):
+        # Called with the config lock held, so records are numbered and queued in the order they were applied
+        record['seq'] = self.sequence + 1
+        self.sequence = record['seq']
+        with self.pending_lock:
+            self.pending.append(record)
+
+    def flush(self):
+        """Writes the records appended so far, returns once they are on disk.
+        Called without the config lock, an fsync on an SD card can take a while."""
+        with self.write_lock:
+            with self.pending_lock:
+                (records, self.pending) = (self.pending, [])
+            if len(records) == 0: return
+            with open(self.path, "a") as file:
+                for record in records:
+                    file.write(json.dumps(record, separators=(',', ':')) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.records += len(records)
+
+    def reset(self):
+        # Called with the config lock held once the config file includes every record, pending ones included
+        with self.write_lock:
+            with self.pending_lock:
+                self.pending = []
+            with open(self.path, "w") as file:
+                os.fsync(file.fileno())
+            self.records = 0
+
+def config_change(config, journal, record):
+    """Applies a change to the config and appends it to the journal, returns
+    False if it changed nothing. The record is on disk once journal.flush()
+    returns."""
+    record['seq'] = journal.sequence + 1
+    if not config_apply(config, record):
+        return False
+    journal.append(record)
+    return True
+
+class MpdError(Exception):
+    def __init__(self, message, command_index = 0):
+        super().__init__(message)
+        self.command_index = command_index
+
+class MpdClient:
+    """Long-lived connection to MPD speaking its text protocol.
+
+    Commands are tuples (name, arg1, arg2...). Several commands sent together
+    are pipelined in a single command_list_begin/command_list_end block.
+    The connection is opened lazily and re-opened once if MPD dropped it."""
+
+    def __init__(self, logger, host, port, timeout = MPD_TIMEOUT):
+        self.logger  = logger
+        self.host    = host
+        self.port    = port
+        self.timeout = timeout
+        self.socket  = None
+        self.file    = None
+        self.version = None
+
+    def connect(self):
+        self.disconnect()
+        self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        self.file = self.socket.makefile('rwb')
+        greeting = self.file.readline().decode('utf-8').strip()
+        if not greeting.startswith('OK MPD '):
+            self.disconnect()
+            raise MpdError('Unexpected greeting from MPD : ' + greeting)
+        self.version = greeting[len('OK MPD '):]
+        self.logger.info('Audio : connected to MPD {0} on {1}:{2}'.format(self.version, self.host, self.port))
+
+    def disconnect(self):
+        for closeable in (self.file, self.socket):
+            if closeable is None: continue
+            try: closeable.close()
+            except OSError: pass
+        self.file = None
+        self.socket = None
+
+    @staticmethod
+    def quote(arg):
+        return '"' + str(arg).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def format_command(self, command):
+        return ' '.join([command[0]] + [self.quote(arg) for arg in command[1:]]) + '\n'
+
+    def read_response(self):
+        lines = []
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError('MPD closed the connection')
+            line = line.decode('utf-8').rstrip('\n')
+            if line == 'OK':
+                return lines
+            if line.startswith('ACK '):
+                # ACK [error@command_list_num] {current_command} message_text
+                command_index = 0
+                try: command_index = int(line[line.index('@')+1:line.index(']')])
+                except ValueError: pass
+                raise MpdError(line, command_index)
+            lines.append(line)
+
+    def command_list(self, commands):
+        if len(commands) == 0: return []
+        if len(commands) == 1:
+            data = self.format_command(commands[0])
+        else:
+            data = 'command_list_begin\n' + ''.join([self.format_command(command) for command in commands]) + 'command_list_end\n'
+        data = data.encode('utf-8')
+        for attempt in range(2):
+            try:
+                if self.file is None: self.connect()
+                self.file.write(data)
+                self.file.flush()
+                return self.read_response()
+            except OSError:
+                self.disconnect()
+                if attempt > 0: raise
+                self.logger.debug('Audio : connection to MPD lost, reconnecting')
+
+    def command(self, *command):
+        return self.command_list([command])
+
+    @staticmethod
+    def parse_pairs(lines):
+        pairs = []
+        for line in lines:
+            key, separator, value = line.partition(': ')
+            if separator: pairs.append((key, value))
+        return pairs
+
+def audio_execute(logger, mpd, commands):
+    try:
+        return mpd.command_list(commands)
+    except (OSError, MpdError) as e:
+        logger.error('Audio : MPD command failed : {0}'.format(e))
+        return None
+
+def audio_set_volume(logger, mpd, percent):
+    logger.info('Audio : set volume at {0}'.format(percent), extra={'coalesce' : True})
     if os.name == 'nt': return
-    subprocess.call(["mpc", "vol", str(percent)])
+    with metrics.timer('clock_raspio_audio_command_seconds', 'set_volume'):
+        audio_execute(logger, mpd, [("setvol", percent)])
 
-def audio_set_playlist(logger, playlist):
+def audio_set_playlist(logger, mpd, playlist):
     logger.info('Audio : set playlist')
     if os.name == 'nt': return
-    subprocess.call(["mpc", "stop"])
-    subprocess.call(["mpc", "clear"])
-    for item in playlist.items:
-        logger.info('   - ' + item)
-        subprocess.call(["mpc", "add", item])
+    begin = time.time()
+    items = [media_cache.resolve(item) for item in playlist.items] if playlist else []
+    lines = audio_execute(logger, mpd, [("stop",), ("playlistinfo",)])
+    if lines is None: return
+    queue = [value for (key, value) in MpdClient.parse_pairs(lines) if key == 'file']
+
+    # Keep the part of the queue MPD already has, only send what differs
+    kept_count = 0
+    while kept_count < len(queue) and kept_count < len(items) and queue[kept_count] == items[kept_count]:
+        kept_count += 1
+    commands = []
+    if kept_count < len(queue):
+        commands.append(("delete", "{0}:".format(kept_count)))
+    for item in items[kept_count:]:
+        logger.debug('   - ' + item)
+        commands.append(("add", item))
+
+    # A failing command aborts the rest of a command list, skip it and send the remainder
+    while len(commands) > 0:
+        try:
+            mpd.command_list(commands)
+            break
+        except MpdError as e:
+            logger.error('Audio : {0} failed : {1}'.format(commands[e.command_index], e))
+            commands = commands[e.command_index+1:]
+        except OSError as e:
+            logger.error('Audio : MPD command failed : {0}'.format(e))
+            break
+    metrics.observe('clock_raspio_audio_command_seconds', time.time() - begin, 'set_playlist')
+    logger.info('Audio : playlist loaded in {0:.3f}s, {1} items kept, {2} items added'.format(time.time() - begin, kept_count, len(items) - kept_count))
 
-def audio_play(logger):
+def audio_play(logger, mpd):
     logger.info('Audio : play')
     if os.name == 'nt': return
-    subprocess.call(["mpc", "repeat", "on"])
-    subprocess.call(["mpc", "play"])
+    with metrics.timer('clock_raspio_audio_command_seconds', 'play'):
+        audio_execute(logger, mpd, [("repeat", 1), ("play", 0)])
 
-def audio_stop(logger):
+def audio_stop(logger, mpd):
     logger.info('Audio : stop')
     if os.name == 'nt': return
-    subprocess.call(["mpc", "stop"])
-    subprocess.call(["mpc", "clear"])
+    with metrics.timer('clock_raspio_audio_command_seconds', 'stop'):
+        audio_execute(logger, mpd, [("stop",), ("clear",)])
+
+def audio_probe_item(item):
+    # Only remote streams can be dead, files are MPD's business
+    if not (item.startswith('http://') or item.startswith('https://')): return True
+    if media_cache.is_cached(item): return True
+    import requests
+    try:
+        response = requests.get(item, stream=True, timeout=AUDIO_PROBE_TIMEOUT)
+        response.close()
+        return response.status_code < 400
+    except requests.RequestException:
+        return False
+
+def audio_probe_playlist(logger, playlist):
+    """Returns a copy of the playlist without its unreachable streams, or the
+    example chime if nothing is left to play."""
+    import concurrent.futures
+    items = playlist.items if playlist else []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=AUDIO_PROBE_WORKERS) as executor:
+        reachable = list(executor.map(audio_probe_item, items))
+    probed = ConfigPlaylist()
+    for (item, is_reachable) in zip(items, reachable):
+        if is_reachable: probed.items.append(item)
+        else: logger.error('Audio : {0} is unreachable, skipping it'.format(item))
+    if len(probed.items) == 0:
+        logger.error('Audio : nothing to play, falling back to {0}'.format(EXAMPLE_FILE_NAME))
+        probed.items.append(EXAMPLE_FILE_NAME)
+    return probed
+
+# Pending commands a newly posted command makes useless, it takes the place of the first one
+AUDIO_SUPERSEDES = {
+    audio_set_volume   : (audio_set_volume,),
+    audio_set_playlist : (audio_set_playlist, audio_play),
+    audio_play         : (audio_play,),
+    audio_stop         : (audio_set_volume, audio_set_playlist, audio_play, audio_stop),
+}
 
-def update_myself(logger):
-    logger.info('Updating myself')
-    for file_name in UPDATE_URLS:
-        with open(LIB_FOLDER_PATH + file_name, "wb") as file:
-            response = requests.get(UPDATE_URLS[file_name])
-            file.write(response.content)
+class AudioWorker:
+    """Runs the audio commands against MPD in its own thread, so the
+    scheduler never waits on MPD.
+
+    Commands posted while MPD is busy are coalesced with the pending ones
+    they supersede : only the latest volume is sent, a new playlist replaces
+    a pending one and a stop cancels everything still pending."""
+
+    def __init__(self, logger, mpd):
+        self.logger    = logger
+        self.mpd       = mpd
+        self.condition = threading.Condition()
+        # [(function, args, time posted)]
+        self.pending   = []
+        self.busy      = False
+        self.leaving   = False
+        self.thread    = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Pending commands are still sent
+        with self.condition:
+            self.leaving = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def close(self):
+        self.stop()
+        self.mpd.disconnect()
+
+    def post(self, function, *args):
+        with self.condition:
+            superseded = AUDIO_SUPERSEDES.get(function, ())
+            position = len(self.pending)
+            kept = []
+            for command in self.pending:
+                if command[0] in superseded: position = min(position, len(kept))
+                else: kept.append(command)
+            kept.insert(position, (function, args, time.perf_counter()))
+            self.pending = kept
+            self.condition.notify_all()
+
+    def get_depth(self):
+        with self.condition:
+            return len(self.pending) + (1 if self.busy else 0)
+
+    def wait_idle(self, timeout = None):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.pending) == 0 and not self.busy, timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: len(self.pending) > 0 or self.leaving)
+                if len(self.pending) == 0: return
+                (function, args, posted) = self.pending.pop(0)
+                self.busy = True
+            try:
+                function(self.logger, self.mpd, *args)
+            except Exception:
+                self.logger.error('Audio : {0} failed'.format(function.__name__), exc_info=True)
+            metrics.observe('clock_raspio_audio_latency_seconds', time.perf_counter() - posted, function.__name__[len('audio_'):])
+
+def audio_prefetch(logger, state, zone, timeslot_id, playlist):
+    # Runs in its own thread, the scheduler loads the result once it is there
+    probed = audio_probe_playlist(logger, playlist)
+    with state.lock:
+        if zone.prefetch_timeslot_id == timeslot_id:
+            zone.prefetch_playlist = probed
+
+class MediaCache:
+    """Local copies of the remote files of the playlists, so that alarms play
+    from disk whatever the network does.
+
+    The items of the upcoming timeslots are downloaded in the background, a
+    few at once. MPD is given the copies through the web admin since it only
+    plays local files from its own music folder. Once the cache grows over
+    max_size, the least recently used copies are evicted, the ones of the
+    upcoming timeslots last. The modification time of the copies keeps that
+    order across restarts. Streams are told apart from files by their
+    missing length, and are never cached."""
+
+    def __init__(self, max_size = MEDIA_CACHE_MAX_SIZE):
+        self.lock        = threading.Lock()
+        self.max_size    = max_size
+        self.folder_path = None
+        self.base_url    = None
+        self.queue       = queue.Queue()
+        # file name : size, the least recently used first
+        self.entries     = collections.OrderedDict()
+        self.size        = 0
+        self.downloading = set()
+        self.streams     = set()
+        # File names of the items of the upcoming timeslots
+        self.wanted      = set()
+
+    def start(self, logger, folder_path, base_url):
+        os.makedirs(folder_path, exist_ok=True)
+        found = []
+        for name in os.listdir(folder_path):
+            path = os.path.join(folder_path, name)
+            if name.startswith('.'):
+                # Download cut by a restart
+                os.unlink(path)
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, stat.st_size))
+        with self.lock:
+            self.folder_path = folder_path
+            self.base_url = base_url
+            for (mtime, name, size) in sorted(found):
+                self.entries[name] = size
+                self.size += size
+        for index in range(MEDIA_CACHE_WORKERS):
+            threading.Thread(target=self.run, args=(logger,), daemon=True).start()
+        logger.info('Media cache : {0} files, {1:.1f}MB'.format(len(found), self.size / 1e6))
+
+    @staticmethod
+    def is_cacheable(item):
+        if not (item.startswith('http://') or item.startswith('https://')): return False
+        return os.path.splitext(urllib.parse.urlsplit(item).path)[1].lower() in LIBRARY_EXTENSIONS
+
+    @staticmethod
+    def get_file_name(item):
+        import hashlib
+        return hashlib.sha256(item.encode('utf-8')).hexdigest()[:32] + os.path.splitext(urllib.parse.urlsplit(item).path)[1].lower()
+
+    def request(self, items):
+        """Downloads the items not cached yet, the ones given last are
+        evicted last."""
+        items = [item for item in items if self.is_cacheable(item)]
+        with self.lock:
+            if self.folder_path == None: return
+            self.wanted = set([self.get_file_name(item) for item in items])
+            for item in items:
+                if self.get_file_name(item) in self.entries or item in self.downloading or item in self.streams: continue
+                self.downloading.add(item)
+                self.queue.put(item)
+
+    def is_cached(self, item):
+        if not self.is_cacheable(item): return False
+        with self.lock:
+            return self.get_file_name(item) in self.entries
+
+    def resolve(self, item):
+        # Returns the URL of the local copy of an item, or the item itself if it is not cached
+        if not self.is_cacheable(item): return item
+        name = self.get_file_name(item)
+        with self.lock:
+            if not name in self.entries: return item
+            self.entries.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.folder_path, name))
+        except OSError: pass
+        return self.base_url + name
+
+    def run(self, logger):
+        while True:
+            item = self.queue.get()
+            try:
+                self.download(logger, item)
+            finally:
+                with self.lock:
+                    self.downloading.discard(item)
+
+    def download(self, logger, item):
+        import requests
+        name = self.get_file_name(item)
+        path = os.path.join(self.folder_path, name)
+        temporary_path = os.path.join(self.folder_path, '.' + name)
+        begin = time.perf_counter()
+        try:
+            # Not compressed, so the length announced is the length written
+            with requests.get(item, stream=True, timeout=MEDIA_CACHE_TIMEOUT, headers={'Accept-Encoding' : 'identity'}) as response:
+                response.raise_for_status()
+                length = response.headers.get('Content-Length', '')
+                if not length.isdigit() or int(length) > self.max_size:
+                    logger.info('Media cache : {0} is a stream or is too large, it is played from the network'.format(item))
+                    with self.lock:
+                        self.streams.add(item)
+                    return
+                size = 0
+                with open(temporary_path, 'wb') as file:
+                    for chunk in response.iter_content(FILES_CHUNK_SIZE):
+                        file.write(chunk)
+                        size += len(chunk)
+            if size != int(length): raise OSError('got {0} bytes out of {1}'.format(size, length))
+            os.replace(temporary_path, path)
+        except (requests.RequestException, OSError) as e:
+            logger.error('Media cache : could not download {0} : {1}'.format(item, e))
+            if os.path.isfile(temporary_path): os.unlink(temporary_path)
+            return
+        metrics.observe('clock_raspio_media_cache_download_seconds', time.perf_counter() - begin)
+        logger.info('Media cache : {0} downloaded, {1:.1f}MB'.format(item, size / 1e6))
+        with self.lock:
+            self.entries[name] = size
+            self.size += size
+            evicted = self.evict(name)
+        for evicted_name in evicted:
+            try:
+                os.unlink(os.path.join(self.folder_path, evicted_name))
+            except OSError: pass
+        if len(evicted) > 0:
+            logger.info('Media cache : {0} files evicted'.format(len(evicted)))
+
+    def evict(self, keep):
+        # Returns the file names to delete, the least recently used first and the wanted ones last
+        evicted = []
+        for spare_wanted in (True, False):
+            for name in list(self.entries):
+                if self.size <= self.max_size: return evicted
+                if name == keep or (spare_wanted and name in self.wanted): continue
+                self.size -= self.entries.pop(name)
+                evicted.append(name)
+        return evicted
+
+media_cache = MediaCache()
+
+def media_cache_get_upcoming_items(config, now):
+    """Returns the items of the current timeslots and of the ones beginning
+    within MEDIA_CACHE_AHEAD_PERIOD in any zone, the current ones first."""
+    timeslots = []
+    # Zones following the same profile share their timeslots
+    profile_names = []
+    for zone_name in config.get_zone_names():
+        profile_name = config.get_zone_profile_name(zone_name)
+        if not profile_name in profile_names: profile_names.append(profile_name)
+    for profile_name in profile_names:
+        if not profile_name in config.profiles: continue
+        result = config.profiles[profile_name].get_current_timeslot(now)
+        if result != None: timeslots.append((now, result[0]))
+        after = now
+        for index in range(MEDIA_CACHE_MAX_TIMESLOTS):
+            next_timeslot = config.profiles[profile_name].get_next_timeslot(after)
+            if next_timeslot == None or next_timeslot[0] > now + MEDIA_CACHE_AHEAD_PERIOD: break
+            timeslots.append(next_timeslot)
+            after = next_timeslot[0] + 1
+    timeslots = [timeslot for (begin, timeslot) in sorted(timeslots, key=lambda entry: entry[0])]
+    items = []
+    seen = set()
+    for timeslot in timeslots:
+        playlist = config.get_playlist_from_timeslot(timeslot)
+        if playlist == None: continue
+        for item in playlist.items:
+            if item in seen: continue
+            seen.add(item)
+            items.append(item)
+    return items
+
+class MediaLibrary:
+    """On-disk index of the tracks in the files folder and in MPD's music
+    folder, with their tags, durations and sizes, searched page by page.
+
+    A refresh walks the folders but only lists again the directories whose
+    modification time changed since the previous refresh. Tags and durations
+    of music folder tracks come from MPD, which already parsed them."""
+
+    SOURCE_FILES = 'files'
+    SOURCE_MUSIC = 'music'
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS directories (source TEXT, path TEXT, parent TEXT, mtime REAL, PRIMARY KEY (source, path))',
+        'CREATE TABLE IF NOT EXISTS tracks (source TEXT, path TEXT, directory TEXT, uri TEXT, title TEXT, artist TEXT, album TEXT, '
+            'duration REAL, size INTEGER, mtime REAL, search TEXT, sort_key TEXT, PRIMARY KEY (source, path))',
+        'CREATE INDEX IF NOT EXISTS tracks_directory ON tracks (source, directory)',
+        'CREATE INDEX IF NOT EXISTS tracks_sort_key ON tracks (sort_key)',
+    )
+
+    def __init__(self, path, base_url = 'http://localhost'):
+        self.path = path
+        # Of the web admin serving the files folder, files tracks are played by MPD from there
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.refresh_requested = False
+        self.refresh_latest_tick = 0
+        # Bumped when a refresh changed the index, rendered pages are cached for a given version
+        self.version = 0
+
+    def connect(self):
+        import sqlite3
+        # One connection per use, sqlite connections can not be shared between threads
+        db = sqlite3.connect(self.path, timeout=MPD_TIMEOUT)
+        db.row_factory = sqlite3.Row
+        return contextlib.closing(db)
+
+    def initialize(self):
+        with self.connect() as db, db:
+            # Readers are not blocked by a refresh writing
+            db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA: db.execute(statement)
+
+    def request_refresh(self):
+        self.refresh_requested = True
+
+    def start_refresh(self, logger):
+        with self.lock:
+            if self.refreshing: return
+            self.refreshing = True
+        threading.Thread(target=self.refresh_loop, args=(logger,), daemon=True).start()
+
+    def refresh_loop(self, logger):
+        import sqlite3
+        mpd = MpdClient(logger, MPD_HOST, MPD_PORT)
+        try:
+            while True:
+                self.refresh_requested = False
+                self.refresh_latest_tick = time.time()
+                try:
+                    # Created by the first refresh rather than on startup, sqlite3 is slow to import
+                    self.initialize()
+                    self.refresh(logger, mpd)
+                except (OSError, sqlite3.Error) as e:
+                    logger.error('Library : refresh failed : {0}'.format(e))
+                if not self.refresh_requested: break
+        finally:
+            mpd.disconnect()
+            with self.lock:
+                self.refreshing = False
+
+    def refresh(self, logger, mpd):
+        begin = time.time()
+        with metrics.timer('clock_raspio_library_refresh_seconds'):
+            with self.connect() as db, db:
+                changed = self.refresh_source(db, self.SOURCE_FILES, FILES_FOLDER_PATH, None)
+                changed += self.refresh_source(db, self.SOURCE_MUSIC, MUSIC_FOLDER_PATH, mpd)
+        if changed > 0:
+            self.version += 1
+            logger.info('Library : {0} directories indexed in {1:.3f}s'.format(changed, time.time() - begin))
+
+    def refresh_source(self, db, source, root, mpd):
+        """Brings the index of one folder up to date, returns the number of
+        directories listed again."""
+        known = {}
+        for row in db.execute('SELECT path, parent, mtime FROM directories WHERE source = ?', (source,)):
+            known[row['path']] = (row['parent'], row['mtime'])
+        children = {}
+        for (path, (parent, mtime)) in known.items():
+            if parent != None: children.setdefault(parent, []).append(path)
+
+        changed = 0
+        seen = set()
+        pending = [('', None)] if os.path.isdir(root) else []
+        while len(pending) > 0:
+            (path, parent) = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(root, path)).st_mtime
+            except OSError:
+                continue
+            seen.add(path)
+            if path in known and known[path][1] == mtime:
+                # Unchanged, its subdirectories may still have changed
+                pending.extend([(child, path) for child in children.get(path, [])])
+                continue
+            (subdirectories, complete) = self.index_directory(db, source, root, path, mpd)
+            changed += 1
+            # A directory MPD has not scanned yet is listed again on the next refresh
+            db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)', (source, path, parent, mtime if complete else None))
+            pending.extend([(child, path) for child in subdirectories])
+
+        for path in set(known) - seen:
+            db.execute('DELETE FROM directories WHERE source = ? AND path = ?', (source, path))
+            db.execute('DELETE FROM tracks WHERE source = ? AND directory = ?', (source, path))
+            changed += 1
+        return changed
+
+    def index_directory(self, db, source, root, path, mpd):
+        """Lists a directory again, returns (subdirectories, complete)."""
+        subdirectories = []
+        tracks = {}
+        with os.scandir(os.path.join(root, path)) as entries:
+            for entry in entries:
+                # Hidden files include uploads still being written
+                if entry.name.startswith('.'): continue
+                entry_path = os.path.join(path, entry.name) if path else entry.name
+                if entry.is_dir():
+                    subdirectories.append(entry_path)
+                elif entry.name.lower().endswith(LIBRARY_EXTENSIONS):
+                    stat = entry.stat()
+                    tracks[entry_path] = {'title' : os.path.splitext(entry.name)[0], 'artist' : '', 'album' : '', 'duration' : None, 'size' : stat.st_size, 'mtime' : stat.st_mtime}
+
+        complete = True
+        if mpd != None and len(tracks) > 0:
+            complete = self.read_tags(mpd, path, tracks)
+
+        db.execute('DELETE FROM tracks WHERE source = ? AND directory = ?', (source, path))
+        rows = []
+        for (track_path, track) in tracks.items():
+            uri = track_path if source == self.SOURCE_MUSIC else self.get_files_uri(track_path)
+            search = ' '.join((track['artist'], track['album'], track['title'], track_path)).lower()
+            sort_key = '\0'.join((track['artist'], track['album'], track['title'], track_path)).lower()
+            rows.append((source, track_path, path, uri, track['title'], track['artist'], track['album'], track['duration'], track['size'], track['mtime'], search, sort_key))
+        db.executemany('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return (subdirectories, complete)
+
+    @staticmethod
+    def read_tags(mpd, path, tracks):
+        """Fills the tracks with the tags MPD knows, returns False if MPD does
+        not know all of them yet."""
+        try:
+            lines = mpd.command('lsinfo', path) if path else mpd.command('lsinfo')
+        except (OSError, MpdError):
+            return False
+        track = None
+        known_count = 0
+        for (key, value) in MpdClient.parse_pairs(lines):
+            if key in ('file', 'directory', 'playlist'):
+                track = tracks.get(value) if key == 'file' else None
+                if track != None: known_count += 1
+            elif track == None:
+                continue
+            elif key in ('Title', 'Artist', 'Album'):
+                track[key.lower()] = value
+            elif key in ('duration', 'Time') and (key == 'duration' or track['duration'] == None):
+                track['duration'] = float(value)
+        return known_count == len(tracks)
+
+    def search(self, query, offset = 0, limit = LIBRARY_PAGE_SIZE):
+        """Returns (total count, tracks) for the tracks matching all the words
+        of the query, sorted by artist, album and title."""
+        conditions = []
+        args = []
+        for word in query.lower().split():
+            conditions.append("search LIKE ? ESCAPE '\\'")
+            args.append('%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        limit = max(0, min(limit, LIBRARY_MAX_PAGE_SIZE))
+        import sqlite3
+        try:
+            with metrics.timer('clock_raspio_library_search_seconds'):
+                with self.connect() as db:
+                    total = db.execute('SELECT COUNT(*) FROM tracks' + where, args).fetchone()[0]
+                    rows = db.execute('SELECT uri, title, artist, album, duration, size, source, path FROM tracks' + where + ' ORDER BY sort_key LIMIT ? OFFSET ?', args + [limit, max(0, offset)]).fetchall()
+        except sqlite3.Error:
+            # Not indexed yet, or the index could not be opened which the refresh already logs
+            return (0, [])
+        tracks = []
+        for row in rows:
+            track = dict(row)
+            # Built again on each search, the port of the web admin may have changed since the track was indexed
+            if track['source'] == self.SOURCE_FILES: track['uri'] = self.get_files_uri(track['path'])
+            del track['path']
+            tracks.append(track)
+        return (total, tracks)
+
+    def get_files_uri(self, track_path):
+        return self.base_url + WebadminHandler.PATHS_FILES + '/' + urllib.parse.quote(track_path)
+
+def update_hash(contents):
+    import hashlib
+    return hashlib.sha256(contents).hexdigest()
+
+def update_fetch(base_url, path, validators):
+    """Downloads a file unless it did not change since it was last
+    downloaded, returns (contents or None if unchanged, validators)."""
+    import requests
+    headers = {}
+    if 'etag' in validators: headers['If-None-Match'] = validators['etag']
+    if 'last_modified' in validators: headers['If-Modified-Since'] = validators['last_modified']
+    response = requests.get(base_url + path, headers=headers, timeout=UPDATE_TIMEOUT)
+    if response.status_code == 304: return (None, validators)
+    response.raise_for_status()
+    validators = {}
+    if 'ETag' in response.headers: validators['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers: validators['last_modified'] = response.headers['Last-Modified']
+    return (response.content, validators)
+
+def update_write(path, contents):
+    # Written aside then renamed, like the config
+    (handle, temporary_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.update-')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            file.write(contents)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except:
+        os.unlink(temporary_path)
+        raise
+
+def update_install(logger, contents):
+    """Swaps the new files in as a set. Each file is recorded in the swap
+    file before it is moved, so one cut half way is rolled back on the next
+    start, for the files it moved only."""
+    staged = {}
+    try:
+        for file_name in contents:
+            staged[file_name] = LIB_FOLDER_PATH + '.update-new-' + file_name
+            update_write(staged[file_name], contents[file_name])
+        # Left by an older update, a .previous file now only exists for a file this swap moved
+        for file_name in contents:
+            if os.path.isfile(LIB_FOLDER_PATH + file_name + '.previous'):
+                os.unlink(LIB_FOLDER_PATH + file_name + '.previous')
+        # [(file name, whether there was a version to put back)]
+        swapped = []
+        for file_name in sorted(contents):
+            had_previous = os.path.isfile(LIB_FOLDER_PATH + file_name)
+            swapped.append((file_name, had_previous))
+            update_write(UPDATE_SWAP_FILE_PATH, json.dumps(swapped).encode('utf-8'))
+            if had_previous:
+                os.replace(LIB_FOLDER_PATH + file_name, LIB_FOLDER_PATH + file_name + '.previous')
+            os.replace(staged[file_name], LIB_FOLDER_PATH + file_name)
+        os.unlink(UPDATE_SWAP_FILE_PATH)
+    except OSError as e:
+        logger.error('Update : could not install the new files : {0}'.format(e))
+        for staged_path in staged.values():
+            if os.path.isfile(staged_path): os.unlink(staged_path)
+        if os.path.isfile(UPDATE_SWAP_FILE_PATH): update_rollback(logger)
+        return False
+    return True
+
+def update_rollback(logger):
+    """Puts back the files the latest update replaced, the ones recorded in
+    the swap file when it was cut half way, all of them otherwise."""
+    logger.error('Update : rolling back to the previous version')
+    try:
+        with open(UPDATE_SWAP_FILE_PATH, 'r') as file:
+            swapped = [(file_name, had_previous) for (file_name, had_previous) in json.load(file) if file_name in UPDATE_PATHS]
+    except (OSError, ValueError, TypeError):
+        # The new version itself failed to load, its swap was complete
+        swapped = [(file_name, os.path.isfile(LIB_FOLDER_PATH + file_name + '.previous')) for file_name in UPDATE_PATHS]
+    for (file_name, had_previous) in swapped:
+        if had_previous:
+            # Missing when the swap was cut before moving this file, which is then still the previous version
+            if os.path.isfile(LIB_FOLDER_PATH + file_name + '.previous'):
+                os.replace(LIB_FOLDER_PATH + file_name + '.previous', LIB_FOLDER_PATH + file_name)
+        elif os.path.isfile(LIB_FOLDER_PATH + file_name):
+            # There was no previous update, the installed version runs again
+            os.unlink(LIB_FOLDER_PATH + file_name)
+    # The download state describes the files rolled back, they are downloaded again next time
+    if os.path.isfile(UPDATE_STATE_FILE_PATH): os.unlink(UPDATE_STATE_FILE_PATH)
+    if os.path.isfile(UPDATE_SWAP_FILE_PATH): os.unlink(UPDATE_SWAP_FILE_PATH)
+
+def update_myself(logger, base_url = UPDATE_BASE_URL):
+    """Downloads the latest program, stylesheet and template, checks them
+    against the manifest and installs them together. Returns True if a new
+    version was installed."""
+    import concurrent.futures
+    import requests
+    logger.info('Updating myself from {0}'.format(base_url))
+    begin = time.time()
+    try:
+        with open(UPDATE_STATE_FILE_PATH, 'r') as file:
+            update_state = json.load(file)
+    except (OSError, ValueError):
+        update_state = {}
+    current = {}
+    for file_name in UPDATE_PATHS:
+        try:
+            with open(LIB_FOLDER_PATH + file_name, 'rb') as file:
+                current[file_name] = file.read()
+        except OSError:
+            # Nothing to compare a 304 to, download it again
+            update_state.pop(file_name, None)
+
+    # The manifest is small and always downloaded, the files only when they changed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(UPDATE_PATHS) + 1) as executor:
+        manifest_future = executor.submit(update_fetch, base_url, UPDATE_MANIFEST_PATH, {})
+        futures = dict([(file_name, executor.submit(update_fetch, base_url, UPDATE_PATHS[file_name], update_state.get(file_name, {}))) for file_name in UPDATE_PATHS])
+        try:
+            manifest = json.loads(manifest_future.result()[0].decode('utf-8'))
+            results = dict([(file_name, futures[file_name].result()) for file_name in UPDATE_PATHS])
+        except (requests.RequestException, ValueError) as e:
+            logger.error('Update : download failed : {0}'.format(e))
+            return False
+
+    contents = {}
+    for file_name in UPDATE_PATHS:
+        (downloaded, validators) = results[file_name]
+        update_state[file_name] = validators
+        contents[file_name] = downloaded if downloaded != None else current[file_name]
+        if update_hash(contents[file_name]) != manifest.get(UPDATE_PATHS[file_name]):
+            logger.error('Update : {0} does not match the manifest, nothing installed'.format(UPDATE_PATHS[file_name]))
+            # In case a local file was modified behind a 304, download everything next time
+            if os.path.isfile(UPDATE_STATE_FILE_PATH): os.unlink(UPDATE_STATE_FILE_PATH)
+            return False
+
+    changed = [file_name for file_name in UPDATE_PATHS if contents[file_name] != current.get(file_name)]
+    logger.info('Update : {0} files downloaded, {1} changed, in {2:.3f}s'.format(
+        len([result for result in results.values() if result[0] != None]), len(changed), time.time() - begin))
+    # Always installed as a whole, the new program may depend on the new template
+    if len(changed) > 0 and not update_install(logger, contents): return False
+    try:
+        update_write(UPDATE_STATE_FILE_PATH, json.dumps(update_state).encode('utf-8'))
+    except OSError as e:
+        logger.error('Update : could not save the download state : {0}'.format(e))
+    return len(changed) > 0
 
-class State:
+class ZoneState:
     def __init__(self):
         self.latest_snooze_time        = 0
         self.discarded_timeslot_id     = None
-        self.discard_requested         = True
-        self.latest_soundout_tick      = time.time()
-        self.config_save_latest_tick   = time.time()
+        self.discard_requested         = False
         self.previous_timeslot_id      = None
         self.previous_volume           = None
-        self.config_save_requested     = False
-        self.update_requested          = False
+        # Upcoming timeslot whose playlist is probed then loaded ahead of its begin
+        self.prefetch_timeslot_id      = None
+        self.prefetch_playlist         = None
+        self.prefetch_loaded           = False
 
     def snooze(self):
         self.latest_snooze_time = time.time()
@@ -550,12 +2632,245 @@ class State:
     def discard(self):
         self.discard_requested = True
 
+class State:
+    def __init__(self):
+        # Held by the web admin threads and the scheduler while they read or modify the config and the state
+        self.lock                      = threading.RLock()
+        self.config_save_latest_tick   = time.time()
+        self.config_save_requested     = False
+        # Bumped on every config change, rendered pages are cached for a given version
+        self.config_version            = 0
+        self.update_requested          = False
+        # zone name : ZoneState, created on first use
+        self.zones                     = {}
+
+    def request_config_save(self):
+        self.config_save_requested = True
+        self.config_version += 1
+
+    def get_zone(self, zone_name = DEFAULT_ZONE_NAME):
+        with self.lock:
+            zone = self.zones.get(zone_name)
+            if zone == None:
+                zone = self.zones[zone_name] = ZoneState()
+            return zone
+
     def request_update(self):
         self.update_requested = True
 
-def main_loop(css_file_path, template_file_path):
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+class Scheduler:
+    """Sleeps until a deadline, waking early when a registered file becomes
+    readable, when a signal is received or when wake() is called."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_read, self.wakeup_write = socket.socketpair()
+        self.wakeup_read.setblocking(False)
+        self.wakeup_write.setblocking(False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, None)
+        signal.set_wakeup_fd(self.wakeup_write.fileno())
+
+    def register(self, fileobj, callback):
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def wake(self):
+        try: self.wakeup_write.send(b'\0')
+        except BlockingIOError: pass
+
+    def wait(self, deadline):
+        timeout = min(deadline - time.time(), SCHEDULER_MAX_SLEEP)
+        if timeout < 0: timeout = 0
+        for (key, events) in self.selector.select(timeout):
+            if key.data is None:
+                try:
+                    while self.wakeup_read.recv(4096): pass
+                except BlockingIOError: pass
+            else:
+                key.data()
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        self.selector.close()
+        self.wakeup_read.close()
+        self.wakeup_write.close()
+
+def soundout_tick(logger, audio, config, state, now, zone_name = DEFAULT_ZONE_NAME):
+    """Starts, fades or stops the audio of a zone for the instant now, and
+    returns the time at which this must be evaluated again."""
+    # Decide under the lock, post to the audio worker once it is released so the web admin is not held
+    audio_actions = []
+    with state.lock:
+        zone = state.get_zone(zone_name)
+        next_tick = now + SCHEDULER_MAX_SLEEP
+        with metrics.timer('clock_raspio_timeslot_lookup_seconds'):
+            next_timeslot = config.get_next_timeslot(now, zone_name)
+            result = config.get_current_timeslot(now, zone_name)
+        if next_timeslot != None and next_timeslot[0] < next_tick: next_tick = next_timeslot[0]
+
+        # Check if we should be playing
+        (current_timeslot, duration_percent, fade_in_percent ) = (None, 0, 0)
+        is_snoozed = zone.latest_snooze_time != 0 and zone.latest_snooze_time <= now and now < zone.latest_snooze_time + config.snooze_duration
+        if is_snoozed:
+            result = None
+            next_tick = min(next_tick, zone.latest_snooze_time + config.snooze_duration)
+        if result != None:
+            (current_timeslot, duration_percent, fade_in_percent ) = result
+            next_tick = min(next_tick, now + (1. - duration_percent) * current_timeslot.duration)
+            new_timeslot_id = current_timeslot.get_id()
+            if zone.discard_requested:
+                zone.discard_requested = False
+                zone.discarded_timeslot_id = new_timeslot_id
+            if zone.discarded_timeslot_id == new_timeslot_id:
+                current_timeslot = None
+
+        if current_timeslot != None:
+            # Volume follows the fade plan, the next change is the next deadline
+            fade_plan = fade_plan_get(current_timeslot.fade_in_duration, current_timeslot.fade_in_curve)
+            elapsed = duration_percent * current_timeslot.duration
+            new_volume = fade_plan.get_volume(elapsed)
+            if new_volume != zone.previous_volume:
+                zone.previous_volume = new_volume
+                audio_actions.append((audio_set_volume, new_volume))
+            next_fade_offset = fade_plan.get_next_offset(elapsed)
+            if next_fade_offset != None:
+                next_tick = min(next_tick, now + next_fade_offset - elapsed)
+
+            if new_timeslot_id != zone.previous_timeslot_id:
+                zone.previous_timeslot_id = new_timeslot_id
+                playlist = config.get_playlist_from_timeslot(current_timeslot)
+                playlist = playlist.copy() if playlist else None
+                if zone.prefetch_timeslot_id == new_timeslot_id and zone.prefetch_playlist != None:
+                    # Already probed and most likely already in MPD's queue
+                    playlist = zone.prefetch_playlist
+                zone.prefetch_timeslot_id = None
+                zone.prefetch_playlist = None
+                audio_actions.append((audio_set_playlist, playlist))
+                audio_actions.append((audio_play,))
+
+        else:
+            if zone.previous_timeslot_id != None:
+                zone.previous_timeslot_id = None
+                zone.previous_volume = None
+                audio_actions.append((audio_stop,))
+
+            # Probe and load the next playlist ahead of time so the alarm starts at once
+            if next_timeslot != None and zone.previous_timeslot_id == None:
+                (next_begin, timeslot) = next_timeslot
+                timeslot_id = timeslot.get_id()
+                if now < next_begin - AUDIO_PREFETCH_PERIOD:
+                    next_tick = min(next_tick, next_begin - AUDIO_PREFETCH_PERIOD)
+                elif zone.prefetch_timeslot_id != timeslot_id:
+                    zone.prefetch_timeslot_id = timeslot_id
+                    zone.prefetch_playlist = None
+                    zone.prefetch_loaded = False
+                    playlist = config.get_playlist_from_timeslot(timeslot)
+                    threading.Thread(target=audio_prefetch, args=(logger, state, zone, timeslot_id, playlist.copy() if playlist else None), daemon=True).start()
+                    next_tick = min(next_tick, now + AUDIO_PREFETCH_POLL_PERIOD)
+                elif zone.prefetch_playlist == None:
+                    next_tick = min(next_tick, now + AUDIO_PREFETCH_POLL_PERIOD)
+                elif not zone.prefetch_loaded:
+                    zone.prefetch_loaded = True
+                    audio_actions.append((audio_set_playlist, zone.prefetch_playlist))
+
+        # Published once, whatever the number of clients listening
+        status = {}
+        status['playing'] = zone.previous_timeslot_id != None
+        status['volume'] = zone.previous_volume
+        status['playlist_name'] = current_timeslot.playlist_name if current_timeslot != None else None
+        status['timeslot_end'] = round(now + (1. - duration_percent) * current_timeslot.duration) if current_timeslot != None else None
+        status['snoozed_until'] = zone.latest_snooze_time + config.snooze_duration if is_snoozed else None
+        status['discarded'] = result != None and current_timeslot == None
+        status['next_timeslot_begin'] = next_timeslot[0] if next_timeslot != None else None
+        status_channel.publish(zone_name, status)
+
+        # Reset snooze
+        if zone.latest_snooze_time != 0 and zone.latest_snooze_time + config.snooze_duration <= now:
+            zone.latest_snooze_time = 0
+
+    for audio_action in audio_actions:
+        audio.post(*audio_action)
+
+    return next_tick
+
+def zones_sync(logger, config, state, zone_audios):
+    """Starts an audio worker for each zone of the config, and stops the ones
+    of the zones removed or moved to another MPD. Each zone has its own
+    worker and MPD connection, so a slow MPD only delays its own zone."""
+    with state.lock:
+        endpoints = dict([(zone_name, config.get_zone_endpoint(zone_name)) for zone_name in config.get_zone_names()])
+    for zone_name in list(zone_audios):
+        (endpoint, audio) = zone_audios[zone_name]
+        if endpoints.get(zone_name) == endpoint: continue
+        zone_audios.pop(zone_name)
+        audio.post(audio_stop)
+        # Closed in the background, the stop may wait for MPD
+        threading.Thread(target=audio.close, daemon=True).start()
+        with state.lock:
+            state.zones.pop(zone_name, None)
+        status_channel.remove(zone_name)
+    for zone_name in endpoints:
+        if zone_name in zone_audios: continue
+        zone_logger = logger if zone_name == DEFAULT_ZONE_NAME else logger.getChild(zone_name)
+        (host, port) = endpoints[zone_name]
+        audio = AudioWorker(zone_logger, MpdClient(zone_logger, host, port)).start()
+        audio.post(audio_stop)
+        zone_audios[zone_name] = (endpoints[zone_name], audio)
+
+def template_load(logger, template_file_path):
+    import jinja2
+    # Compiled templates are kept on disk, keyed by the template source, and reused by the next starts
+    bytecode_cache = None
+    try:
+        os.makedirs(TEMPLATE_CACHE_FOLDER_PATH, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_FOLDER_PATH)
+    except OSError as e:
+        logger.error('Could not create the template cache : {0}'.format(e))
+    begin = time.perf_counter()
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(template_file_path)), bytecode_cache=bytecode_cache, auto_reload=False)
+    template = environment.get_template(os.path.basename(template_file_path))
+    logger.info('Template {0} loaded in {1:.0f}ms'.format(template_file_path, (time.perf_counter() - begin)*1e3))
+    return template
+
+class StartupTimer:
+    """Durations of the startup phases, logged once the daemon is ready."""
+
+    def __init__(self, begin):
+        self.begin  = begin
+        self.latest = begin
+        self.phases = []
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.latest))
+        self.latest = now
+
+    def log(self, logger):
+        durations = ', '.join(['{0} {1:.0f}ms'.format(name, duration*1e3) for (name, duration) in self.phases])
+        logger.info('Startup : {0}, total {1:.0f}ms'.format(durations, (self.latest - self.begin)*1e3))
+
+def set_lib_folder(path):
+    # Lets several instances run side by side, each with its own config
+    global LIB_FOLDER_PATH, CONFIG_FILE_PATH, CONFIG_JOURNAL_FILE_PATH, FILES_FOLDER_PATH, MUSIC_FOLDER_PATH, LIBRARY_FILE_PATH, TEMPLATE_CACHE_FOLDER_PATH
+    global UPDATE_STATE_FILE_PATH, UPDATE_SWAP_FILE_PATH, MEDIA_CACHE_FOLDER_PATH
+    LIB_FOLDER_PATH          = os.path.join(path, '')
+    CONFIG_FILE_PATH         = LIB_FOLDER_PATH + 'config.json'
+    CONFIG_JOURNAL_FILE_PATH = LIB_FOLDER_PATH + 'config.journal'
+    FILES_FOLDER_PATH        = LIB_FOLDER_PATH + 'files/'
+    MUSIC_FOLDER_PATH        = LIB_FOLDER_PATH + 'music/'
+    LIBRARY_FILE_PATH        = LIB_FOLDER_PATH + 'library.sqlite'
+    TEMPLATE_CACHE_FOLDER_PATH = LIB_FOLDER_PATH + 'template-cache/'
+    MEDIA_CACHE_FOLDER_PATH  = LIB_FOLDER_PATH + 'cache/'
+    UPDATE_STATE_FILE_PATH   = LIB_FOLDER_PATH + 'update-state.json'
+    UPDATE_SWAP_FILE_PATH    = LIB_FOLDER_PATH + 'update-swap.json'
+
+def set_share_folder(path):
+    global SHARE_FOLDER_PATH, CSS_FILE_PATH, TEMPLATE_FILE_PATH, FAVICON_FILE_PATH
+    SHARE_FOLDER_PATH        = os.path.join(path, '')
+    CSS_FILE_PATH            = SHARE_FOLDER_PATH + 'stylesheet.css'
+    TEMPLATE_FILE_PATH       = SHARE_FOLDER_PATH + 'template.html'
+    FAVICON_FILE_PATH        = SHARE_FOLDER_PATH + 'favicon.ico'
+
+def main_loop(css_file_path, template_file_path, port = WEBADMIN_PORT, update_base_url = UPDATE_BASE_URL):
     logging_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logging_stdout = logging.StreamHandler(sys.stdout)
     logging_stdout.setFormatter(logging_formatter)
@@ -563,106 +2878,195 @@ def main_loop(css_file_path, template_file_path):
     logging_stderr = logging.StreamHandler(sys.stderr)
     logging_stderr.setFormatter(logging_formatter)
     logging_stderr.setLevel(logging.ERROR)
-    logger.addHandler(logging_stdout)
-    logger.addHandler(logging_stderr)
-
+    # Written from their own thread, a slow journald does not hold the scheduler
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_queue_handler = LogQueueHandler(log_queue)
+    log_writer = LogWriter(log_queue, log_queue_handler, [logging_stdout, logging_stderr])
+    log_writer.start()
+    atexit.register(log_writer.stop)
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.getLogger().addHandler(log_queue_handler)
+    log_set_levels(LOG_LEVELS)
+    logger = logging.getLogger(LOG_NAME)
+    audio_logger = logger.getChild('audio')
+    config_logger = logger.getChild('config')
+
+    startup = StartupTimer(STARTUP_BEGIN)
+    startup.phase('imports')
     logger.info('Starting daemon')
     logger.info('Templates are {0} {1}'.format(css_file_path, template_file_path) )
 
     signal_handler = SignalHandler()
     signal.signal(signal.SIGTERM, signal_handler)
 
-    config = config_load(logger, CONFIG_FILE_PATH)
-    # imediately save config to apply format updates
-    config_save(logger, CONFIG_FILE_PATH, config)
+    config = config_load(config_logger, CONFIG_FILE_PATH)
+    startup.phase('config load')
+    journal = ConfigJournal(CONFIG_JOURNAL_FILE_PATH)
+    journal.replay(config_logger, config)
+    startup.phase('journal replay')
+    # save config to apply format updates and compact the journal, a config already up to date is not written again
+    if config.format_version != CONFIG_FORMAT_VERSION or journal.records > 0:
+        if config_compact(config_logger, CONFIG_FILE_PATH, config, journal):
+            config.format_version = CONFIG_FORMAT_VERSION
+        startup.phase('config save')
 
     state = State()
 
-    WebadminHandler.logger = logger
+    WebadminHandler.logger = logger.getChild('webadmin')
     WebadminHandler.config = config
+    WebadminHandler.journal = journal
     WebadminHandler.state = state
+    scheduler = Scheduler()
+    WebadminHandler.scheduler = scheduler
+    library = MediaLibrary(LIBRARY_FILE_PATH, 'http://127.0.0.1:{0}'.format(port))
+    WebadminHandler.library = library
     with open(css_file_path, 'rb') as file:
         WebadminHandler.contents_stylesheet = file.read()
-    with open(template_file_path, 'rb') as file:
-        WebadminHandler.template_index = jinja2.Template(file.read().decode('utf-8'))
+    WebadminHandler.template_index = None
+    WebadminHandler.template_file_path = template_file_path
     try:
         with open(FAVICON_FILE_PATH, 'rb') as file:
             WebadminHandler.contents_favicon = file.read()
     except: pass
     
-    webadmin_server = http.server.HTTPServer( server_address=('', 80), RequestHandlerClass=WebadminHandler )
-    webadmin_server.timeout = 0.1
-
-    audio_stop(logger)
+    # Connections are accepted by the scheduler, each request is then handled in its own thread
+    webadmin_server = WebadminServer( server_address=('', port), RequestHandlerClass=WebadminHandler )
+    webadmin_server.timeout = 0
+    scheduler.register(webadmin_server, webadmin_server.handle_request)
+    startup.phase('webadmin')
 
+    try:
+        media_cache.start(logger.getChild('cache'), MEDIA_CACHE_FOLDER_PATH, 'http://127.0.0.1:{0}{1}/'.format(port, WebadminHandler.PATHS_CACHE))
+    except OSError as e:
+        logger.getChild('cache').error('Media cache : could not open {0} : {1}'.format(MEDIA_CACHE_FOLDER_PATH, e))
+    metrics.register_gauge('clock_raspio_media_cache_bytes', lambda: media_cache.size)
+    media_cache_latest_tick = 0
+    media_cache_config_version = None
+    startup.phase('media cache')
+
+    # zone name : (MPD endpoint, AudioWorker), the web admin is given a new copy on every change so it reads it unlocked
+    zone_audios = {}
+    zones_sync(audio_logger, config, state, zone_audios)
+    zones_config_version = state.config_version
+    WebadminHandler.zone_audios = dict(zone_audios)
+    metrics.register_gauge('clock_raspio_audio_queue_depth', lambda: sum([audio.get_depth() for (endpoint, audio) in WebadminHandler.zone_audios.values()]))
+    metrics.register_gauge('clock_raspio_status_listeners', lambda: status_channel.listeners)
+    startup.phase('audio')
+
+    next_tick = time.time()
     while True:
         now = time.time()
+        if now >= next_tick:
+            metrics.observe('clock_raspio_tick_lateness_seconds', now - next_tick)
+        tick_begin = time.perf_counter()
 
         # Leave
         if signal_handler.must_leave:
             break
 
-        # Run webadmin
-        webadmin_server.handle_request()
-
-        # save config
-        if state.config_save_requested and now > state.config_save_latest_tick + CONFIG_SAVE_PERIOD:
-            state.config_save_requested = False
-            state.config_save_latest_tick = now
-            config_save(logger, CONFIG_FILE_PATH, config)
+        # save config, changes are already safe in the journal so this is only compacting it
+        config_save_deadline = state.config_save_latest_tick + CONFIG_SAVE_PERIOD
+        if journal.records >= CONFIG_JOURNAL_MAX_RECORDS: config_save_deadline = now
+        if state.config_save_requested and now >= config_save_deadline:
+            with state.lock:
+                state.config_save_requested = False
+                state.config_save_latest_tick = now
+                config_compact(config_logger, CONFIG_FILE_PATH, config, journal)
 
         if DEVEL_MODE and state.update_requested:
-            update_myself(logger)
-            break
-
-        # Soundout
-        if now > state.latest_soundout_tick + SOUNDOUT_PERIOD:
-            state.latest_soundout_tick = now
-            # Check if we should be playing
-            (current_timeslot, duration_percent, fade_in_percent ) = (None, 0, 0)
-            result = config.get_current_timeslot(now)
-            is_snoozed = state.latest_snooze_time != 0 and state.latest_snooze_time <= now and now < state.latest_snooze_time + config.snooze_duration
-            if is_snoozed: result = None
-            if result != None:
-                (current_timeslot, duration_percent, fade_in_percent ) = result
-                new_timeslot_id = current_timeslot.get_id()
-                if state.discarded_timeslot_id == new_timeslot_id:
-                    current_timeslot = None
-
-            if current_timeslot != None:
-                new_volume = int(fade_in_percent*100)
-                if new_volume != state.previous_volume:
-                    state.previous_volume = new_volume
-                    audio_set_volume( logger, new_volume )
-
-                if new_timeslot_id != state.previous_timeslot_id:
-                    state.previous_timeslot_id = new_timeslot_id
-                    audio_set_playlist( logger, config.get_playlist_from_timeslot(current_timeslot) )
-                    audio_play(logger)
-
-                if state.discard_requested:
-                    state.discarded_timeslot_id = new_timeslot_id
-
-            else:
-                if state.previous_timeslot_id != None:
-                    state.previous_timeslot_id = None
-                    audio_stop(logger)
-
-            # Reset snooze
-            if state.latest_snooze_time != 0 and state.latest_snooze_time + config.snooze_duration <= now:
-                state.latest_snooze_time = 0
-
-    logger.info('Saving config')
-    config_save(logger, CONFIG_FILE_PATH, config)
+            state.update_requested = False
+            # Restarted by leaving, only when a new version was installed
+            if update_myself(logger.getChild('update'), update_base_url): break
+
+        # Zones added, removed or moved to another MPD
+        if zones_config_version != state.config_version:
+            zones_config_version = state.config_version
+            zones_sync(audio_logger, config, state, zone_audios)
+            WebadminHandler.zone_audios = dict(zone_audios)
+
+        # Soundout, re-evaluated on every wakeup since a request may have changed the config or the state
+        next_tick = now + SCHEDULER_MAX_SLEEP
+        for zone_name in sorted(zone_audios):
+            audio = zone_audios[zone_name][1]
+            next_tick = min(next_tick, soundout_tick(audio.logger, audio, config, state, now, zone_name))
+        if state.config_save_requested:
+            next_tick = min(next_tick, config_save_deadline)
+
+        # Media library, refreshed in its own thread since a first scan of a large collection takes a while
+        if library.refresh_requested or now >= library.refresh_latest_tick + LIBRARY_REFRESH_PERIOD:
+            library.start_refresh(logger.getChild('library'))
+        next_tick = min(next_tick, max(now, library.refresh_latest_tick) + LIBRARY_REFRESH_PERIOD)
+
+        # Media cache, the remote files of the upcoming timeslots are downloaded in the background
+        if now >= media_cache_latest_tick + MEDIA_CACHE_PERIOD or media_cache_config_version != state.config_version:
+            media_cache_latest_tick = now
+            with state.lock:
+                media_cache_config_version = state.config_version
+                items = media_cache_get_upcoming_items(config, now)
+            media_cache.request(items)
+        next_tick = min(next_tick, media_cache_latest_tick + MEDIA_CACHE_PERIOD)
+
+        if startup != None:
+            startup.phase('first tick')
+            startup.log(logger)
+            startup = None
+            # Alarms are covered, the template can now be compiled ahead of the first page
+            threading.Thread(target=WebadminHandler.get_template_index, daemon=True).start()
+
+        # Sleep until something is due, a request comes in or a signal is received
+        metrics.observe('clock_raspio_tick_duration_seconds', time.perf_counter() - tick_begin)
+        scheduler.wait(next_tick)
+
+    with state.lock:
+        if state.config_save_requested or journal.records > 0:
+            logger.info('Saving config')
+            config_compact(config_logger, CONFIG_FILE_PATH, config, journal)
+    for (endpoint, audio) in zone_audios.values():
+        audio.close()
+    scheduler.close()
+    webadmin_server.server_close()
     logger.info('Exiting daemon')
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Clock-raspio daemon')
+    parser.add_argument('--port', type=int, default=WEBADMIN_PORT, help='port of the web admin')
+    parser.add_argument('--mpd-port', type=int, default=MPD_PORT, help='port of MPD')
+    parser.add_argument('--lib-folder', help='folder holding the config and the files, instead of ' + LIB_FOLDER_PATH)
+    parser.add_argument('--share-folder', help='folder holding the template and the stylesheet, instead of ' + SHARE_FOLDER_PATH)
+    parser.add_argument('--update-url', default=UPDATE_BASE_URL, help='where updates are downloaded from')
+    parser.add_argument('--log-level', action='append', default=[], metavar='SUBSYSTEM=LEVEL', help='level of one of ' + ', '.join(LOG_SUBSYSTEMS))
+    arguments = parser.parse_args()
+    log_levels = dict([log_level.partition('=')[::2] for log_level in arguments.log_level])
+    try:
+        log_set_levels(log_levels)
+    except ValueError as e:
+        parser.error(e)
+    if arguments.lib_folder: set_lib_folder(arguments.lib_folder)
+    if arguments.share_folder: set_share_folder(arguments.share_folder)
+
+    program = sys.modules[__name__]
+    css_file_path = CSS_FILE_PATH
+    template_file_path = TEMPLATE_FILE_PATH
+    if DEVEL_MODE and os.path.isfile(UPDATE_SWAP_FILE_PATH):
+        # An update was cut while swapping its files in
+        update_rollback(logging.getLogger())
     if DEVEL_MODE and os.path.isfile(LIB_FOLDER_PATH + UPDATED_PROGRAM_FILE_NAME):
         print('DEVEL MODE : RUNNING UPDATED VERSION')
         import importlib.util
-        spec = importlib.util.spec_from_file_location("updated", LIB_FOLDER_PATH + UPDATED_PROGRAM_FILE_NAME)
-        foo = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(foo)
-        foo.main_loop(LIB_FOLDER_PATH + UPDATED_CSS_FILE_NAME, LIB_FOLDER_PATH + UPDATED_TEMPLATE_FILE_NAME)
-    else:
-        main_loop(CSS_FILE_PATH, TEMPLATE_FILE_PATH)
+        try:
+            spec = importlib.util.spec_from_file_location("updated", LIB_FOLDER_PATH + UPDATED_PROGRAM_FILE_NAME)
+            foo = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(foo)
+            program = foo
+            css_file_path = LIB_FOLDER_PATH + UPDATED_CSS_FILE_NAME
+            template_file_path = LIB_FOLDER_PATH + UPDATED_TEMPLATE_FILE_NAME
+            if arguments.lib_folder: program.set_lib_folder(arguments.lib_folder)
+            if arguments.share_folder: program.set_share_folder(arguments.share_folder)
+        except Exception:
+            print('DEVEL MODE : UPDATED VERSION DOES NOT LOAD, ROLLING BACK')
+            update_rollback(logging.getLogger())
+            program = sys.modules[__name__]
+    program.MPD_PORT = arguments.mpd_port
+    program.LOG_LEVELS.update(log_levels)
+    program.main_loop(css_file_path, template_file_path, arguments.port, arguments.update_url)
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# Benchmarks of the scheduling, config and web admin paths against synthetic
+# configs of increasing size.
+#   python3 tools/clock-raspio-bench.py --output results.json
+#   python3 tools/clock-raspio-bench.py --save-baseline baseline.json
+#   python3 tools/clock-raspio-bench.py --baseline baseline.json
+# Timings depend on the machine, so no baseline is shipped : save one on the
+# machine the comparisons will run on, before the changes to measure.
+import argparse
+import http.client
+import http.server
+import importlib.util
+import jinja2
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+TOOLS_FOLDER_PATH   = os.path.dirname(os.path.abspath(__file__))
+SERVICE_FILE_PATH   = os.path.join(TOOLS_FOLDER_PATH, '..', 'files', 'clock-raspio-service.py')
+FAKE_MPD_FILE_PATH  = os.path.join(TOOLS_FOLDER_PATH, 'fake-mpd.py')
+TEMPLATE_FILE_PATH  = os.path.join(TOOLS_FOLDER_PATH, '..', 'files', 'share', 'template.html')
+
+TIMESLOT_COUNTS       = (1, 10, 100, 1000, 10000)
+PLAYLIST_ITEM_COUNTS  = (1, 100, 1000, 10000, 100000)
+QUICK_TIMESLOT_COUNTS       = (1, 100)
+QUICK_PLAYLIST_ITEM_COUNTS  = (1, 1000)
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(function, min_time, repeat = 3):
+    """Returns the best time per call, in seconds, over repeat runs of at least min_time each."""
+    best = None
+    for run in range(repeat):
+        calls = 0
+        begin = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - begin
+            if elapsed >= min_time: break
+        per_call = elapsed / calls
+        if best == None or per_call < best: best = per_call
+    return best
+
+def make_config(service, timeslot_count, item_count):
+    config = service.Config(set_sensible_default = True)
+    timetable = config.profiles['Work'].timetable
+    timetable.period = timetable.PERIOD_ONEMONTH
+    timetable.timeslots = []
+    for index in range(timeslot_count):
+        timeslot = service.ConfigTimeslot()
+        timeslot.from_json({'begin_day' : index % 31, 'begin_hour' : (index // 31) % 24, 'begin_minute' : (index // (31*24)) % 60,
+            'duration' : 1800, 'fade_in_duration' : 300, 'playlist_name' : 'Default playlist'})
+        timetable.timeslots.append(timeslot)
+    timetable.invalidate_index()
+    config.playlists['Default playlist'].items = ['http://radio.example/{0}.mp3'.format(index) for index in range(item_count)]
+    return config
+
+def bench_timeslot_lookup(service, counts, min_time):
+    results = {}
+    for count in counts:
+        config = make_config(service, count, 1)
+        now = [time.time()]
+        def lookup():
+            now[0] += 37
+            config.get_current_timeslot(now[0])
+            config.get_next_timeslot(now[0])
+        results['timeslot_lookup/{0}'.format(count)] = measure(lookup, min_time)
+    return results
+
+def bench_config(service, logger, counts, min_time):
+    results = {}
+    folder = tempfile.mkdtemp(prefix='clock-raspio-bench-')
+    path = os.path.join(folder, 'config.json')
+    for count in counts:
+        config = make_config(service, 10, count)
+        def json_round_trip():
+            service.ConfigDecoder()(json.loads(json.dumps(service.ConfigEncoder()(config))))
+        def file_round_trip():
+            service.config_save(logger, path, config)
+            service.config_load(logger, path)
+        results['config_json/{0}'.format(count)] = measure(json_round_trip, min_time)
+        results['config_file/{0}'.format(count)] = measure(file_round_trip, min_time)
+    return results
+
+def start_webadmin(service, logger, config):
+    service.WebadminHandler.logger = logger
+    service.WebadminHandler.config = config
+    service.WebadminHandler.state = service.State()
+    folder = tempfile.mkdtemp(prefix='clock-raspio-bench-')
+    service.WebadminHandler.journal = service.ConfigJournal(os.path.join(folder, 'config.journal'))
+    service.WebadminHandler.library = service.MediaLibrary(os.path.join(folder, 'library.sqlite'))
+    service.WebadminHandler.scheduler = None
+    service.WebadminHandler.render_cache = service.RenderCache()
+    with open(TEMPLATE_FILE_PATH, 'rb') as file:
+        service.WebadminHandler.template_index = jinja2.Template(file.read().decode('utf-8'))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), service.WebadminHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_webadmin(service, logger, fake_mpd_module, counts, min_time):
+    results = {}
+    fake_mpd = fake_mpd_module.FakeMpdServer().start()
+    for count in counts:
+        config = make_config(service, 100, count)
+        server = start_webadmin(service, logger, config)
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+        def get(path, headers = {}):
+            connection.request('GET', path, headers = headers)
+            response = connection.getresponse()
+            response.read()
+            return response
+        def render():
+            # A config change between requests forces a new render every time
+            service.WebadminHandler.state.config_version += 1
+            get('/config/playlist/Default%20playlist')
+        etag = get('/config').getheader('ETag')
+        results['config_render/{0}'.format(count)] = measure(render, min_time)
+        results['config_cached/{0}'.format(count)] = measure(lambda: get('/config', {'Accept-Encoding' : 'gzip'}), min_time)
+        results['config_not_modified/{0}'.format(count)] = measure(lambda: get('/config', {'If-None-Match' : etag}), min_time)
+
+        # Requests served while the scheduler drives the fake MPD
+        mpd = service.MpdClient(logger, '127.0.0.1', fake_mpd.port)
+        audio = service.AudioWorker(logger, mpd).start()
+        stop = threading.Event()
+        def soundout():
+            now = time.time()
+            while not stop.is_set():
+                now += 1
+                service.soundout_tick(logger, audio, config, service.WebadminHandler.state, now)
+                audio.wait_idle()
+        soundout_thread = threading.Thread(target=soundout, daemon=True)
+        soundout_thread.start()
+        results['requests_with_audio/{0}'.format(count)] = measure(lambda: get('/config'), min_time)
+        stop.set()
+        soundout_thread.join()
+        audio.stop()
+        mpd.disconnect()
+        connection.close()
+        server.shutdown()
+        server.server_close()
+    fake_mpd.stop()
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name in sorted(results):
+        if not name in baseline: continue
+        ratio = results[name] / baseline[name] if baseline[name] > 0 else 1.
+        status = 'REGRESSION' if ratio > 1. + tolerance else 'ok'
+        if status != 'ok': regressions.append(name)
+        print('{0:40} {1:12.3f}us {2:12.3f}us {3:7.2f}x {4}'.format(name, baseline[name]*1e6, results[name]*1e6, ratio, status))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks clock-raspio against synthetic configs')
+    parser.add_argument('--quick', action='store_true', help='only run the smaller sizes')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimal duration of each measure, in seconds')
+    parser.add_argument('--only', choices=('timeslots', 'config', 'webadmin'), action='append', help='run only these benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results to this JSON file')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    arguments = parser.parse_args()
+
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    service = load_module('clock_raspio', SERVICE_FILE_PATH)
+    fake_mpd_module = load_module('fake_mpd', FAKE_MPD_FILE_PATH)
+
+    timeslot_counts = QUICK_TIMESLOT_COUNTS if arguments.quick else TIMESLOT_COUNTS
+    item_counts = QUICK_PLAYLIST_ITEM_COUNTS if arguments.quick else PLAYLIST_ITEM_COUNTS
+    only = arguments.only or ('timeslots', 'config', 'webadmin')
+
+    results = {}
+    if 'timeslots' in only: results.update(bench_timeslot_lookup(service, timeslot_counts, arguments.min_time))
+    if 'config' in only:    results.update(bench_config(service, logger, item_counts, arguments.min_time))
+    if 'webadmin' in only:  results.update(bench_webadmin(service, logger, fake_mpd_module, item_counts, arguments.min_time))
+
+    document = {
+        'python'   : platform.python_version(),
+        'machine'  : platform.machine(),
+        'date'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results'  : results,
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(document, file, sort_keys=True, indent=4)
+    if arguments.save_baseline:
+        with open(arguments.save_baseline, 'w') as file:
+            json.dump(document, file, sort_keys=True, indent=4)
+
+    if arguments.baseline:
+        with open(arguments.baseline, 'r') as file:
+            baseline = json.load(file)['results']
+        print('{0:40} {1:>14} {2:>14} {3:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+        if compare(results, baseline, arguments.tolerance):
+            return 1
+    elif not arguments.output:
+        json.dump(document, sys.stdout, sort_keys=True, indent=4)
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
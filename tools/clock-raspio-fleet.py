@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+# Controller for a fleet of clock-raspio devices: pushes one config to all of
+# them, collects their status and metrics, and reports the ones whose config
+# drifted away from it. Devices are reached concurrently.
+#   python3 tools/clock-raspio-fleet.py fleet.json push
+#   python3 tools/clock-raspio-fleet.py fleet.json status
+#   python3 tools/clock-raspio-fleet.py fleet.json drift
+# fleet.json lists the devices and the config they should have, either inline
+# or as the path of a config.json exported with GET /api/config :
+#   {"config" : "config.json", "devices" : ["http://kitchen.local", "http://127.0.0.1:8081"]}
+import argparse
+import asyncio
+import json
+import os
+import sys
+import urllib.parse
+
+FLEET_CONCURRENCY   = 32
+FLEET_TIMEOUT       = 10
+# Parts of the config pushed to the devices, and compared to find drifts. Zones
+# are left out, they name the MPD of each room and the devices keep their own.
+FLEET_CONFIG_KEYS   = ('current_profile_name', 'snooze_duration', 'profiles', 'playlists', 'timezone')
+
+class FleetError(Exception):
+    pass
+
+class FleetClient:
+    """Minimal asynchronous HTTP/1.1 client for the devices' JSON API.
+
+    Connections are pooled per device and kept open between requests, at most
+    concurrency requests are in flight at once across the whole fleet."""
+
+    def __init__(self, timeout = FLEET_TIMEOUT, concurrency = FLEET_CONCURRENCY):
+        self.timeout   = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # (host, port) : [(reader, writer)]
+        self.idle      = {}
+
+    async def request(self, method, url, dct = None):
+        """Returns (status code, decoded JSON body or None)."""
+        split = urllib.parse.urlsplit(url)
+        key = (split.hostname, split.port or 80)
+        path = (split.path or '/') + ('?' + split.query if split.query else '')
+        body = json.dumps(dct).encode('utf-8') if dct is not None else b''
+        async with self.semaphore:
+            (status, contents) = await asyncio.wait_for(self.exchange(key, method, path, body), self.timeout)
+        try:
+            return (status, json.loads(contents.decode('utf-8')) if contents else None)
+        except ValueError:
+            return (status, None)
+
+    async def exchange(self, key, method, path, body):
+        connections = self.idle.setdefault(key, [])
+        while len(connections) > 0:
+            (reader, writer) = connections.pop()
+            try:
+                return await self.exchange_on(key, reader, writer, method, path, body)
+            except (OSError, asyncio.IncompleteReadError, FleetError):
+                # The device closed this idle connection, try the next one
+                writer.close()
+        (reader, writer) = await asyncio.open_connection(*key)
+        try:
+            return await self.exchange_on(key, reader, writer, method, path, body)
+        except (OSError, asyncio.IncompleteReadError, FleetError):
+            writer.close()
+            raise
+
+    async def exchange_on(self, key, reader, writer, method, path, body):
+        try:
+            request = '{0} {1} HTTP/1.1\r\nHost: {2}:{3}\r\nContent-Type: application/json\r\nContent-Length: {4}\r\n\r\n'.format(
+                method, path, key[0], key[1], len(body))
+            writer.write(request.encode('latin-1') + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line: raise FleetError('Connection closed')
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line: break
+                (name, separator, value) = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if 'content-length' in headers:
+                contents = await reader.readexactly(int(headers['content-length']))
+            else:
+                contents = await reader.read()
+                headers['connection'] = 'close'
+        except asyncio.CancelledError:
+            # Timed out half way through, the connection can not be reused
+            writer.close()
+            raise
+        if headers.get('connection', '').lower() == 'close': writer.close()
+        else: self.idle[key].append((reader, writer))
+        return (status, contents)
+
+    def close(self):
+        for connections in self.idle.values():
+            for (reader, writer) in connections: writer.close()
+        self.idle = {}
+
+def load_fleet(path):
+    with open(path, 'r') as file:
+        fleet = json.load(file)
+    config = fleet.get('config', {})
+    if isinstance(config, str):
+        with open(os.path.join(os.path.dirname(os.path.abspath(path)), config), 'r') as file:
+            config = json.load(file)
+    config = dict([(key, config[key]) for key in FLEET_CONFIG_KEYS if key in config])
+    return (fleet['devices'], config)
+
+def summarize_metrics(dct):
+    # Count and mean duration of each histogram, all labels together, and the value of each gauge
+    summary = {}
+    for (name, labels) in dct.items():
+        if 'value' in labels.get('', {}):
+            summary[name] = {'value' : labels['']['value']}
+            continue
+        count = sum([entry['count'] for entry in labels.values()])
+        total = sum([entry['sum'] for entry in labels.values()])
+        summary[name] = {'count' : count, 'mean' : total / count if count else 0.}
+    return summary
+
+async def device_push(client, device, config):
+    (status, response) = await client.request('POST', device + '/api/config', config)
+    if status != 200: raise FleetError('push answered {0} {1}'.format(status, response))
+    return {'config_version' : response['config_version']}
+
+async def device_status(client, device, config):
+    ((status, dct), (metrics_status, metrics)) = await asyncio.gather(
+        client.request('GET', device + '/api/status'),
+        client.request('GET', device + '/metrics.json'))
+    if status != 200: raise FleetError('status answered {0}'.format(status))
+    dct['metrics'] = summarize_metrics(metrics) if metrics_status == 200 and metrics else {}
+    return dct
+
+async def device_drift(client, device, config):
+    (status, actual) = await client.request('GET', device + '/api/config')
+    if status != 200: raise FleetError('config answered {0}'.format(status))
+    drifted = [key for key in FLEET_CONFIG_KEYS if key in config and config[key] != actual.get(key)]
+    return {'drifted' : drifted}
+
+FLEET_COMMANDS = {
+    'push'   : device_push,
+    'status' : device_status,
+    'drift'  : device_drift,
+}
+
+async def run(command, devices, config, timeout, concurrency):
+    """Returns {device : (result, error)}."""
+    client = FleetClient(timeout, concurrency)
+    try:
+        results = await asyncio.gather(*[FLEET_COMMANDS[command](client, device.rstrip('/'), config) for device in devices], return_exceptions = True)
+    finally:
+        client.close()
+    report = {}
+    for (device, result) in zip(devices, results):
+        if isinstance(result, asyncio.TimeoutError): report[device] = (None, 'timed out')
+        elif isinstance(result, Exception): report[device] = (None, '{0}'.format(result) or type(result).__name__)
+        else: report[device] = (result, None)
+    return report
+
+def format_result(command, result):
+    if command == 'push':
+        return 'pushed, config version {0}'.format(result['config_version'])
+    if command == 'drift':
+        return 'drifted : ' + ', '.join(result['drifted']) if result['drifted'] else 'in sync'
+    requests = result['metrics'].get('clock_raspio_request_seconds', {'count' : 0, 'mean' : 0.})
+    lateness = result['metrics'].get('clock_raspio_tick_lateness_seconds', {'count' : 0, 'mean' : 0.})
+    return 'profile {0}, {1}, {2} requests in {3:.1f}ms, ticks {4:.1f}ms late, {5} audio commands queued'.format(
+        result['current_profile_name'], 'playing' if result['playing'] else 'silent',
+        requests['count'], requests['mean']*1e3, lateness['mean']*1e3, result.get('audio_queue_depth', 0))
+
+def main():
+    parser = argparse.ArgumentParser(description='Manages a fleet of clock-raspio devices')
+    parser.add_argument('fleet', help='JSON file listing the devices and their config')
+    parser.add_argument('command', choices=sorted(FLEET_COMMANDS), help='push the config, collect the status or report drifts')
+    parser.add_argument('--timeout', type=float, default=FLEET_TIMEOUT, help='timeout of each request, in seconds')
+    parser.add_argument('--concurrency', type=int, default=FLEET_CONCURRENCY, help='requests in flight at once')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    arguments = parser.parse_args()
+
+    (devices, config) = load_fleet(arguments.fleet)
+    report = asyncio.run(run(arguments.command, devices, config, arguments.timeout, arguments.concurrency))
+
+    failed = False
+    for device in devices:
+        (result, error) = report[device]
+        if error != None or (arguments.command == 'drift' and result['drifted']): failed = True
+    if arguments.json:
+        json.dump(dict([(device, {'result' : result, 'error' : error}) for (device, (result, error)) in report.items()]), sys.stdout, sort_keys=True, indent=4)
+        print()
+    else:
+        for device in devices:
+            (result, error) = report[device]
+            print('{0:32} {1}'.format(device, 'ERROR ' + error if error != None else format_result(arguments.command, result)))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
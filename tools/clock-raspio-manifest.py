@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# Writes files/update-manifest.json, the hashes of the files downloaded by the
+# self-update. Run it and commit the manifest with every change of these files,
+# devices refuse an update whose files do not match it.
+#   python3 tools/clock-raspio-manifest.py
+#   python3 tools/clock-raspio-manifest.py --check
+import argparse
+import importlib.util
+import json
+import os
+import sys
+
+TOOLS_FOLDER_PATH   = os.path.dirname(os.path.abspath(__file__))
+FILES_FOLDER_PATH   = os.path.join(TOOLS_FOLDER_PATH, '..', 'files')
+SERVICE_FILE_PATH   = os.path.join(FILES_FOLDER_PATH, 'clock-raspio-service.py')
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_manifest(service):
+    manifest = {}
+    for path in sorted(service.UPDATE_PATHS.values()):
+        with open(os.path.join(FILES_FOLDER_PATH, path), 'rb') as file:
+            manifest[path] = service.update_hash(file.read())
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes the manifest checked by the self-update')
+    parser.add_argument('--check', action='store_true', help='only check that the manifest is up to date')
+    arguments = parser.parse_args()
+
+    service = load_module('clock_raspio', SERVICE_FILE_PATH)
+    manifest = make_manifest(service)
+    manifest_file_path = os.path.join(FILES_FOLDER_PATH, service.UPDATE_MANIFEST_PATH)
+    if arguments.check:
+        try:
+            with open(manifest_file_path, 'r') as file:
+                up_to_date = json.load(file) == manifest
+        except (OSError, ValueError):
+            up_to_date = False
+        print('Manifest is up to date' if up_to_date else 'Manifest is out of date')
+        return 0 if up_to_date else 1
+    with open(manifest_file_path, 'w') as file:
+        json.dump(manifest, file, sort_keys=True, indent=4)
+        file.write('\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
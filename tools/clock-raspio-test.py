@@ -0,0 +1,903 @@
+#!/usr/bin/python3
+# Tests of the scheduler, audio, config, web admin, media cache, fleet and
+# self-update paths against fake MPD servers, local HTTP servers and local
+# daemons, no device or network needed.
+#   python3 tools/clock-raspio-test.py
+#   python3 tools/clock-raspio-test.py -v ZonesTest
+import asyncio
+import datetime
+import functools
+import gzip
+import http.client
+import http.server
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.request
+
+TOOLS_FOLDER_PATH   = os.path.dirname(os.path.abspath(__file__))
+FILES_FOLDER_PATH   = os.path.join(TOOLS_FOLDER_PATH, '..', 'files')
+SERVICE_FILE_PATH   = os.path.join(FILES_FOLDER_PATH, 'clock-raspio-service.py')
+FAKE_MPD_FILE_PATH  = os.path.join(TOOLS_FOLDER_PATH, 'fake-mpd.py')
+FLEET_FILE_PATH     = os.path.join(TOOLS_FOLDER_PATH, 'clock-raspio-fleet.py')
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+service = load_module('clock_raspio', SERVICE_FILE_PATH)
+fake_mpd = load_module('fake_mpd', FAKE_MPD_FILE_PATH)
+fleet = load_module('fleet', FLEET_FILE_PATH)
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+logger = logging.getLogger('test')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+def make_playlist(items):
+    playlist = service.ConfigPlaylist()
+    playlist.items = list(items)
+    return playlist
+
+def make_timeslot(**values):
+    dct = service.ConfigTimeslot().to_json()
+    dct.update(values)
+    timeslot = service.ConfigTimeslot()
+    timeslot.from_json(dct)
+    return timeslot
+
+def linear_scan(timetable, now):
+    # The lookup before timetables were indexed, the first matching timeslot in timetable order
+    nowdt = datetime.datetime.fromtimestamp(now)
+    current_day = timetable.get_day_index(nowdt.date())
+    current_s = nowdt.hour * 3600 + nowdt.minute *60 + nowdt.second
+    for timeslot in timetable.timeslots:
+        timeslot_begin_s = (timeslot.begin_hour *3600 + timeslot.begin_minute * 60)
+        if timeslot.begin_day == current_day and timeslot_begin_s <= current_s and current_s < timeslot_begin_s + timeslot.duration:
+            fade_in_percent = min(1., (current_s - timeslot_begin_s) / (timeslot.fade_in_duration))
+            return (timeslot, (current_s - timeslot_begin_s) / (timeslot.duration), fade_in_percent)
+    return None
+
+class TimetableTest(unittest.TestCase):
+
+    def test_index_matches_linear_scan(self):
+        generator = random.Random(4)
+        for period in (service.ConfigTimetable.PERIOD_ONEDAY, service.ConfigTimetable.PERIOD_ONEWEEK,
+                service.ConfigTimetable.PERIOD_TWOWEEKS, service.ConfigTimetable.PERIOD_ONEMONTH):
+            day_count = {service.ConfigTimetable.PERIOD_ONEDAY : 1, service.ConfigTimetable.PERIOD_ONEWEEK : 7,
+                service.ConfigTimetable.PERIOD_TWOWEEKS : 14, service.ConfigTimetable.PERIOD_ONEMONTH : 32}[period]
+            timetable = service.ConfigTimetable()
+            timetable.period = period
+            # Overlapping, running past midnight, and on days the period never reaches
+            timetable.timeslots = [make_timeslot(begin_hour = generator.randrange(24), begin_minute = generator.randrange(60),
+                begin_day = generator.randrange(day_count + 1), duration = generator.randrange(1, 6*3600),
+                fade_in_duration = generator.randrange(1, 600)) for index in range(60)]
+            timetable.invalidate_index()
+            begin = int(datetime.datetime(2026, 1, 1).timestamp())
+            for now in [begin + generator.randrange(40*24*3600) for index in range(3000)]:
+                self.assertEqual(timetable.get_current_timeslot(now), linear_scan(timetable, now))
+
+    def test_next_timeslot(self):
+        timetable = service.ConfigTimetable()
+        timetable.period = timetable.PERIOD_ONEWEEK
+        # Wednesdays at 7:30
+        timetable.timeslots = [make_timeslot(begin_hour = 7, begin_minute = 30, begin_day = 2)]
+        now = datetime.datetime(2026, 10, 19, 12, 0).timestamp()
+        self.assertEqual(timetable.get_next_timeslot(now)[0], datetime.datetime(2026, 10, 21, 7, 30).timestamp())
+        now = datetime.datetime(2026, 10, 21, 7, 31).timestamp()
+        self.assertEqual(timetable.get_next_timeslot(now)[0], datetime.datetime(2026, 10, 28, 7, 30).timestamp())
+
+class FadePlanTest(unittest.TestCase):
+
+    CURVES = {
+        service.ConfigTimeslot.FADE_LINEAR      : lambda progress: progress,
+        service.ConfigTimeslot.FADE_LOGARITHMIC : lambda progress: math.log10(1. + 9.*progress),
+        service.ConfigTimeslot.FADE_PERCEPTUAL  : lambda progress: progress ** 3,
+    }
+
+    def test_plans_follow_their_curve(self):
+        for (curve, function) in self.CURVES.items():
+            for duration in (1, 30, 600):
+                plan = service.FadePlan(duration, curve)
+                self.assertEqual((plan.offsets[0], plan.volumes[0]), (0., 0))
+                self.assertEqual((plan.offsets[-1], plan.volumes[-1]), (duration, 100))
+                for position in range(1, len(plan.offsets)):
+                    self.assertGreater(plan.volumes[position], plan.volumes[position - 1])
+                    self.assertGreaterEqual(plan.offsets[position] - plan.offsets[position - 1], service.FADE_MIN_STEP_PERIOD - 1e-9)
+                for step in range(1, 100):
+                    elapsed = duration * step / 100.
+                    expected = 100. * function(elapsed / duration)
+                    # Never ahead of the curve, and behind it by at most one resolution step once the changes
+                    # skipped as too close, the one before full volume included, have caught up
+                    self.assertLessEqual(plan.get_volume(elapsed), expected + 1e-6)
+                    self.assertGreaterEqual(plan.get_volume(elapsed + 2*service.FADE_MIN_STEP_PERIOD), min(expected, 100.) - service.FADE_VOLUME_RESOLUTION - 1e-6)
+
+    def test_short_fade_is_rate_limited(self):
+        plan = service.FadePlan(1, service.ConfigTimeslot.FADE_LINEAR)
+        self.assertLessEqual(len(plan.offsets), 1 / service.FADE_MIN_STEP_PERIOD + 1)
+        self.assertEqual(service.FadePlan(600, service.ConfigTimeslot.FADE_LINEAR).volumes, list(range(0, 101)))
+
+    def test_next_offset(self):
+        plan = service.FadePlan(10, service.ConfigTimeslot.FADE_LINEAR)
+        self.assertEqual(plan.get_next_offset(0), plan.offsets[1])
+        # Every volume of a 10s linear fade, each 0.1s apart
+        self.assertEqual(plan.volumes, list(range(0, 101)))
+        self.assertAlmostEqual(plan.get_next_offset(5.), 5.1)
+        self.assertEqual(plan.get_next_offset(10), None)
+        plan = service.FadePlan(0, service.ConfigTimeslot.FADE_LINEAR)
+        self.assertEqual((plan.get_volume(0), plan.get_next_offset(0)), (100, None))
+
+class MpdClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_mpd.FakeMpdServer().start()
+        self.mpd = service.MpdClient(logger, '127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.mpd.disconnect()
+        self.server.stop()
+
+    def test_reconnect(self):
+        service.audio_set_volume(logger, self.mpd, 42)
+        # Dropped under the client's feet, the next command opens a new connection
+        self.mpd.socket.shutdown(socket.SHUT_RDWR)
+        service.audio_set_volume(logger, self.mpd, 43)
+        self.assertEqual(self.server.state.volume, 43)
+
+    def test_ack_skips_failing_command(self):
+        service.audio_set_playlist(logger, self.mpd, make_playlist(['a', 'missing1', 'b']))
+        self.assertEqual(self.server.state.queue, ['a', 'b'])
+
+    def test_playlist_diff(self):
+        service.audio_set_playlist(logger, self.mpd, make_playlist(['a', 'b', 'c']))
+        del self.server.state.history[:]
+        service.audio_set_playlist(logger, self.mpd, make_playlist(['a', 'b', 'd', 'e']))
+        self.assertEqual(self.server.state.queue, ['a', 'b', 'd', 'e'])
+        # Only what differs is sent
+        self.assertEqual([command for command in self.server.state.history if command[0] in ('delete', 'add')],
+            [['delete', '2:'], ['add', 'd'], ['add', 'e']])
+
+    def test_quoting(self):
+        service.audio_set_playlist(logger, self.mpd, make_playlist(['a "b"\\c']))
+        self.assertEqual(self.server.state.queue, ['a "b"\\c'])
+
+class AudioWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_mpd.FakeMpdServer().start()
+        self.audio = service.AudioWorker(logger, service.MpdClient(logger, '127.0.0.1', self.server.port)).start()
+        # Holds the worker busy while the commands pile up
+        self.release = threading.Event()
+        self.audio.post(lambda logger, mpd: self.release.wait(5))
+        while len(self.audio.pending) > 0: time.sleep(0.01)
+
+    def tearDown(self):
+        self.release.set()
+        self.audio.close()
+        self.server.stop()
+
+    def run_pending(self):
+        self.release.set()
+        self.assertTrue(self.audio.wait_idle(5))
+        return [command for command in self.server.state.history if command[0] in ('setvol', 'clear', 'delete', 'add', 'play', 'stop')]
+
+    def test_stale_commands_are_coalesced(self):
+        self.audio.post(service.audio_set_volume, 10)
+        self.audio.post(service.audio_set_volume, 20)
+        self.audio.post(service.audio_set_playlist, make_playlist(['a']))
+        self.audio.post(service.audio_play)
+        self.audio.post(service.audio_set_volume, 30)
+        self.audio.post(service.audio_set_playlist, make_playlist(['b']))
+        self.audio.post(service.audio_play)
+        self.assertEqual([command[0] for command in self.audio.pending], [service.audio_set_volume, service.audio_set_playlist, service.audio_play])
+        self.assertEqual(self.audio.get_depth(), 4)
+        commands = self.run_pending()
+        self.assertEqual([command for command in commands if command[0] == 'setvol'], [['setvol', '30']])
+        self.assertEqual((self.server.state.queue, self.server.state.volume, self.server.state.playing), (['b'], 30, 'play'))
+        self.assertEqual(commands[-1][0], 'play')
+
+    def test_stop_cancels_pending_commands(self):
+        self.audio.post(service.audio_set_volume, 10)
+        self.audio.post(service.audio_set_playlist, make_playlist(['a']))
+        self.audio.post(service.audio_play)
+        self.audio.post(service.audio_stop)
+        self.assertEqual(self.run_pending(), [['stop'], ['clear']])
+        self.assertEqual((self.server.state.queue, self.server.state.playing), ([], 'stop'))
+
+class ZonesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [fake_mpd.FakeMpdServer().start() for index in range(3)]
+        self.now = time.time()
+        # Began at the start of the current minute, whatever the time of day
+        nowdt = datetime.datetime.fromtimestamp(self.now)
+        self.config = service.Config(set_sensible_default = True)
+        for (profile_name, begin_hour) in (('Work', nowdt.hour), ('Holidays', (nowdt.hour + 12) % 24)):
+            timetable = self.config.profiles[profile_name].timetable
+            timetable.period = timetable.PERIOD_ONEDAY
+            timetable.timeslots = [make_timeslot(begin_hour = begin_hour, begin_minute = nowdt.minute, fade_in_duration = 0, playlist_name = 'Default playlist')]
+            timetable.invalidate_index()
+        self.config.current_profile_name = 'Work'
+        self.state = service.State()
+        self.zone_audios = {}
+        self.mpd_port = service.MPD_PORT
+        service.MPD_PORT = self.servers[0].port
+        service.MPD_HOST = '127.0.0.1'
+
+    def tearDown(self):
+        for (endpoint, audio) in self.zone_audios.values(): audio.close()
+        for server in self.servers: server.stop()
+        service.MPD_PORT = self.mpd_port
+        service.MPD_HOST = 'localhost'
+
+    def set_zone(self, zone_name, profile_name, server):
+        record = {'op' : 'zone_set', 'zone_name' : zone_name, 'zone' : {'profile_name' : profile_name, 'mpd_host' : '127.0.0.1', 'mpd_port' : server.port}}
+        self.assertTrue(service.config_apply(self.config, record))
+
+    def tick(self):
+        service.zones_sync(logger, self.config, self.state, self.zone_audios)
+        for zone_name in sorted(self.zone_audios):
+            audio = self.zone_audios[zone_name][1]
+            service.soundout_tick(logger, audio, self.config, self.state, self.now, zone_name)
+        for (endpoint, audio) in self.zone_audios.values():
+            self.assertTrue(audio.wait_idle(5))
+        return [server.state.playing for server in self.servers]
+
+    def test_zones_play_their_own_profile(self):
+        self.set_zone('Kitchen', 'Work', self.servers[1])
+        self.set_zone('Bedroom', 'Holidays', self.servers[2])
+        self.assertEqual(self.tick(), ['play', 'play', 'stop'])
+        self.assertEqual(self.servers[1].state.queue, [service.EXAMPLE_FILE_NAME])
+
+    def test_snooze_one_zone(self):
+        self.set_zone('Kitchen', 'Work', self.servers[1])
+        self.assertEqual(self.tick(), ['play', 'play', 'stop'])
+        self.state.get_zone('Kitchen').snooze()
+        self.now = time.time()
+        self.assertEqual(self.tick(), ['play', 'stop', 'stop'])
+        self.assertIsNotNone(service.status_channel.statuses['Kitchen']['snoozed_until'])
+        self.assertIsNone(service.status_channel.statuses[service.DEFAULT_ZONE_NAME]['snoozed_until'])
+
+    def test_set_profile_of_one_zone(self):
+        self.set_zone('Bedroom', 'Holidays', self.servers[2])
+        self.assertEqual(self.tick(), ['play', 'stop', 'stop'])
+        self.assertTrue(service.config_apply(self.config, {'op' : 'set_profile', 'profile_name' : 'Work', 'zone_name' : 'Bedroom'}))
+        self.assertEqual(self.tick(), ['play', 'stop', 'play'])
+
+    def test_remove_zone(self):
+        self.set_zone('Kitchen', 'Work', self.servers[1])
+        self.assertEqual(self.tick(), ['play', 'play', 'stop'])
+        (endpoint, audio) = self.zone_audios['Kitchen']
+        self.assertTrue(service.config_apply(self.config, {'op' : 'zone_remove', 'zone_name' : 'Kitchen'}))
+        self.tick()
+        audio.thread.join(5)
+        self.assertEqual(sorted(self.zone_audios), [service.DEFAULT_ZONE_NAME])
+        self.assertEqual(self.servers[1].state.playing, 'stop')
+        self.assertFalse('Kitchen' in self.state.zones)
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='clock-raspio-test-')
+        self.config = service.Config(set_sensible_default = True)
+        self.journal = service.ConfigJournal(os.path.join(self.folder, 'config.journal'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_invalid_imports_are_rejected(self):
+        timeslot = make_timeslot(begin_hour = 'x').to_json()
+        for dct in ({}, {'current_profile_name' : 'Work', 'profiles' : {'Work' : {'timetable' : {'timeslots' : [timeslot]}}}},
+                {'current_profile_name' : 'Work', 'profiles' : {'Work' : {}}, 'playlists' : {'Radio' : {'items' : [5]}}},
+                {'current_profile_name' : 'Work', 'profiles' : {'Work' : {}}, 'zones' : {'Kitchen' : {'profile_name' : 'Work', 'mpd_port' : 0}}}):
+            self.assertFalse(service.config_change(self.config, self.journal, {'op' : 'import', 'config' : dct}))
+        self.assertEqual(self.journal.records, 0)
+        self.assertEqual(sorted(self.config.profiles), ['Holidays', 'Work'])
+
+    def test_non_string_items_are_rejected(self):
+        self.assertFalse(service.config_apply(self.config, {'op' : 'playlist_add_item', 'playlist_name' : 'Default playlist', 'item' : 5}))
+        self.assertFalse(service.config_apply(self.config, {'op' : 'playlist_set_items', 'playlist_name' : 'Default playlist', 'items' : ['a', 1, None, {}]}))
+        self.assertEqual(self.config.playlists['Default playlist'].items, [service.EXAMPLE_FILE_NAME])
+
+    def test_invalid_names_are_rejected(self):
+        for record in ({'op' : 'playlist_new', 'playlist_name' : 5}, {'op' : 'playlist_new', 'playlist_name' : ''},
+                {'op' : 'playlist_rename', 'playlist_name' : 'Default playlist', 'playlist_new_name' : 5},
+                {'op' : 'zone_set', 'zone_name' : 5, 'zone' : {'profile_name' : 'Work'}}):
+            self.assertFalse(service.config_change(self.config, self.journal, record))
+        self.assertEqual(self.journal.records, 0)
+        # The config can still be written
+        service.config_write(os.path.join(self.folder, 'config.json'), self.config)
+
+    def test_rename_onto_existing_playlist_is_rejected(self):
+        self.assertTrue(service.config_apply(self.config, {'op' : 'playlist_new', 'playlist_name' : 'Radio'}))
+        self.assertFalse(service.config_apply(self.config, {'op' : 'playlist_rename', 'playlist_name' : 'Radio', 'playlist_new_name' : 'Default playlist'}))
+        self.assertEqual(self.config.playlists['Default playlist'].items, [service.EXAMPLE_FILE_NAME])
+        self.assertTrue(service.config_apply(self.config, {'op' : 'playlist_rename', 'playlist_name' : 'Radio', 'playlist_new_name' : 'Radio 2'}))
+        self.assertEqual(sorted(self.config.playlists), ['Default playlist', 'Radio 2'])
+
+    def test_import_keeps_zones(self):
+        self.assertTrue(service.config_apply(self.config, {'op' : 'zone_set', 'zone_name' : 'Kitchen', 'zone' : {'profile_name' : 'Work'}}))
+        dct = self.config.to_json()
+        del dct['zones']
+        self.assertTrue(service.config_apply(self.config, {'op' : 'import', 'config' : dct}))
+        self.assertEqual(sorted(self.config.zones), ['Kitchen'])
+        dct['zones'] = {}
+        self.assertTrue(service.config_apply(self.config, {'op' : 'import', 'config' : dct}))
+        self.assertEqual(self.config.zones, {})
+
+    def test_journal_replay(self):
+        self.assertTrue(service.config_change(self.config, self.journal, {'op' : 'playlist_new', 'playlist_name' : 'Radio'}))
+        self.assertTrue(service.config_change(self.config, self.journal, {'op' : 'set_profile', 'profile_name' : 'Holidays'}))
+        self.journal.flush()
+        replayed = service.Config(set_sensible_default = True)
+        service.ConfigJournal(self.journal.path).replay(logger, replayed)
+        self.assertEqual(replayed.to_json(), self.config.to_json())
+
+    def test_journal_replay_drops_poisoned_records(self):
+        with open(self.journal.path, 'w') as file:
+            for record in (5, {'op' : 'playlist_new'}, {'seq' : 1, 'op' : 'zone_set', 'zone_name' : 'Kitchen', 'zone' : {'profile_name' : 'Work', 'mpd_port' : 'x'}},
+                    {'seq' : 2, 'op' : 'playlist_move_item', 'playlist_name' : 'Default playlist', 'from' : 'x', 'to' : 0},
+                    {'seq' : 3, 'op' : 'playlist_new', 'playlist_name' : 'Radio'}):
+                file.write(json.dumps(record) + '\n')
+        self.journal.replay(logger, self.config)
+        self.assertEqual(sorted(self.config.playlists), ['Default playlist', 'Radio'])
+        self.assertEqual(self.config.zones, {})
+        self.assertEqual((self.config.journal_sequence, self.journal.sequence, self.journal.records), (3, 3, 5))
+        self.assertTrue(service.config_compact(logger, os.path.join(self.folder, 'config.json'), self.config, self.journal))
+        self.assertEqual(self.journal.records, 0)
+
+    def test_failed_save_keeps_journal(self):
+        self.assertTrue(service.config_change(self.config, self.journal, {'op' : 'playlist_new', 'playlist_name' : 'Radio'}))
+        self.journal.flush()
+        self.assertFalse(service.config_compact(logger, os.path.join(self.folder, 'missing', 'config.json'), self.config, self.journal))
+        self.assertEqual(self.journal.records, 1)
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class LogWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.writer = service.LogWriter(None, service.LogQueueHandler(None), [self.handler])
+        self.created = 1000.
+
+    def log(self, message, coalesce = False):
+        self.created += 0.1
+        dct = {'name' : 'clock-raspio.audio', 'levelno' : logging.INFO, 'levelname' : 'INFO', 'msg' : message, 'created' : self.created}
+        if coalesce: dct['coalesce'] = True
+        self.writer.write(logging.makeLogRecord(dct))
+
+    def test_distinct_errors_are_all_written(self):
+        for message in ('Could not open file1.mp3', 'Could not open file2.mp3', 'MPD ACK [50@0]', 'MPD ACK [52@3]'):
+            self.log(message)
+        self.writer.flush(None)
+        self.assertEqual(self.handler.messages, ['Could not open file1.mp3', 'Could not open file2.mp3', 'MPD ACK [50@0]', 'MPD ACK [52@3]'])
+
+    def test_volume_steps_are_coalesced(self):
+        for volume in range(1, 6):
+            self.log('Audio : set volume at {0}'.format(volume), coalesce = True)
+        self.log('Audio : play')
+        self.writer.flush(None)
+        self.assertEqual(self.handler.messages, ['Audio : set volume at 1', 'Audio : set volume at 5 (4 similar messages in 0.4s)', 'Audio : play'])
+
+class TimezoneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = service.TimezoneCache()
+        self.reads = 0
+
+    def failing_read_list(self):
+        self.reads += 1
+        return None
+
+    def test_missing_timedatectl(self):
+        with unittest.mock.patch.object(service.subprocess, 'Popen', side_effect=FileNotFoundError('timedatectl')):
+            self.assertEqual(service.timezone_read_list(), None)
+
+    def test_failure_is_cached_until_retry(self):
+        with unittest.mock.patch.object(service, 'timezone_read_list', self.failing_read_list):
+            self.assertEqual(self.cache.list(), {})
+            self.assertEqual(self.cache.list(), {})
+            self.assertEqual(self.reads, 1)
+            self.cache.get()
+            version = self.cache.get_version()
+            self.assertFalse(version.endswith('s'))
+            # Once the retry is due, the version no longer matches the pages rendered without a catalogue
+            self.cache.timezones_retry_time = time.monotonic() - 1
+            self.assertNotEqual(self.cache.get_version(), version)
+        with unittest.mock.patch.object(service, 'timezone_read_list', return_value={'Europe' : ['Paris']}):
+            self.assertEqual(self.cache.list(), {'Europe' : ['Paris']})
+        self.assertNotEqual(self.cache.get_version(), version)
+
+@unittest.skipIf(jinja2 == None, 'the web admin needs jinja2')
+class WebadminTest(unittest.TestCase):
+    """A web admin on a free port, with its own lib folder."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='clock-raspio-test-')
+        self.lib_folder_path = service.LIB_FOLDER_PATH
+        service.set_lib_folder(self.folder + '/')
+        os.makedirs(service.FILES_FOLDER_PATH)
+        self.config = service.Config(set_sensible_default = True)
+        self.state = service.State()
+        self.journal = service.ConfigJournal(service.CONFIG_JOURNAL_FILE_PATH)
+        service.WebadminHandler.logger = logger
+        service.WebadminHandler.config = self.config
+        service.WebadminHandler.state = self.state
+        service.WebadminHandler.journal = self.journal
+        service.WebadminHandler.scheduler = service.Scheduler()
+        service.WebadminHandler.library = service.MediaLibrary(service.LIBRARY_FILE_PATH)
+        service.WebadminHandler.render_cache = service.RenderCache()
+        service.WebadminHandler.template_index = None
+        service.WebadminHandler.template_file_path = os.path.join(FILES_FOLDER_PATH, 'share', 'template.html')
+        service.WebadminHandler.zone_audios = {}
+        self.server = service.WebadminServer(('127.0.0.1', 0), service.WebadminHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        service.WebadminHandler.scheduler.close()
+        service.set_lib_folder(self.lib_folder_path)
+        shutil.rmtree(self.folder)
+
+    def request(self, method, path, body = None, headers = {}):
+        self.connection.request(method, path, body = body, headers = headers)
+        response = self.connection.getresponse()
+        return (response, response.read())
+
+    def post_json(self, path, dct):
+        (response, body) = self.request('POST', path, json.dumps(dct).encode('utf-8'), {'Content-Type' : 'application/json'})
+        return (response.status, json.loads(body.decode('utf-8')))
+
+    def test_journal_is_written_outside_the_lock(self):
+        # While the record is fsynced, the scheduler can still take the lock
+        acquired = []
+        def try_lock():
+            if self.state.lock.acquire(timeout = 1):
+                acquired.append(True)
+                self.state.lock.release()
+        fsync = os.fsync
+        def slow_fsync(fd):
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            fsync(fd)
+        with unittest.mock.patch.object(service.os, 'fsync', slow_fsync):
+            (code, response) = self.post_json('/api/batch', {'operations' : [{'op' : 'playlist_new', 'playlist_name' : 'Radio'}]})
+        self.assertEqual(code, 200)
+        self.assertEqual(acquired, [True])
+        self.assertEqual(self.journal.records, 1)
+        replayed = service.Config(set_sensible_default = True)
+        service.ConfigJournal(self.journal.path).replay(logger, replayed)
+        self.assertTrue('Radio' in replayed.playlists)
+
+    def test_journal_keeps_the_order_of_concurrent_changes(self):
+        def post(index):
+            connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+            body = json.dumps({'operations' : [{'op' : 'playlist_new', 'playlist_name' : 'P{0}'.format(index)}]})
+            connection.request('POST', '/api/batch', body = body, headers = {'Content-Type' : 'application/json'})
+            connection.getresponse().read()
+            connection.close()
+        threads = [threading.Thread(target=post, args=(index,)) for index in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        with open(self.journal.path, 'r') as file:
+            self.assertEqual([json.loads(line)['seq'] for line in file], list(range(1, 9)))
+        replayed = service.Config(set_sensible_default = True)
+        service.ConfigJournal(self.journal.path).replay(logger, replayed)
+        self.assertEqual(replayed.to_json(), self.config.to_json())
+
+    def test_files_round_trip(self):
+        contents = bytes(range(256)) * 1000
+        (response, body) = self.request('POST', '/files/track.flac', contents)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(os.listdir(service.FILES_FOLDER_PATH), ['track.flac'])
+        (response, body) = self.request('GET', '/files/track.flac')
+        self.assertEqual((response.status, body, response.getheader('Accept-Ranges')), (200, contents, 'bytes'))
+
+    def test_files_ranges(self):
+        with open(os.path.join(service.FILES_FOLDER_PATH, 'a.mp3'), 'wb') as file: file.write(b'0123456789')
+        for (header, status, expected, content_range) in (('bytes=2-5', 206, b'2345', 'bytes 2-5/10'), ('bytes=-3', 206, b'789', 'bytes 7-9/10'),
+                ('bytes=7-', 206, b'789', 'bytes 7-9/10'), ('bytes=8-100', 206, b'89', 'bytes 8-9/10'), ('bytes=10-', 416, b'', 'bytes */10'),
+                ('bytes=0-1,4-5', 200, b'0123456789', None), ('items=0-1', 200, b'0123456789', None)):
+            (response, body) = self.request('GET', '/files/a.mp3', headers = {'Range' : header})
+            self.assertEqual((response.status, body, response.getheader('Content-Range')), (status, expected, content_range), header)
+
+    def test_files_outside_the_folder(self):
+        with open(os.path.join(self.folder, 'secret'), 'wb') as file: file.write(b'secret')
+        for path in ('/files/../secret', '/files/%2e%2e/secret', '/files/a/../../secret', '/files'):
+            (response, body) = self.request('GET', path)
+            self.assertEqual(response.status, 404, path)
+        (response, body) = self.request('POST', '/files/%2e%2e/config.json', b'{}')
+        self.assertEqual(response.status, 404)
+        self.assertFalse(os.path.exists(service.CONFIG_FILE_PATH))
+
+    def test_files_upload_limits(self):
+        with unittest.mock.patch.object(service, 'FILES_MAX_UPLOAD_SIZE', 16):
+            (response, body) = self.request('POST', '/files/big.mp3', b'x' * 17)
+            self.assertEqual(response.status, 413)
+            (response, body) = self.request('POST', '/files/small.mp3', b'x' * 16)
+            self.assertEqual(response.status, 200)
+        # Without a length the body can not be told apart from the next request
+        self.connection.putrequest('POST', '/files/chunked.mp3')
+        self.connection.putheader('Transfer-Encoding', 'chunked')
+        self.connection.endheaders()
+        self.connection.send(b'0\r\n\r\n')
+        response = self.connection.getresponse()
+        response.read()
+        self.assertEqual(response.status, 411)
+        self.assertEqual(sorted(os.listdir(service.FILES_FOLDER_PATH)), ['small.mp3'])
+
+    def test_config_etag(self):
+        reads = []
+        def read_list():
+            reads.append(True)
+            return {'Europe' : ['Paris']}
+        with unittest.mock.patch.object(service, 'timezone_cache', service.TimezoneCache()), \
+                unittest.mock.patch.object(service, 'timezone_read_list', read_list):
+            (response, body) = self.request('GET', '/config')
+            self.assertEqual(response.status, 200)
+            etag = response.getheader('ETag')
+            self.assertTrue(b'Paris' in body)
+            template = service.WebadminHandler.template_index
+            service.WebadminHandler.template_index = unittest.mock.Mock(wraps=template)
+            # Served from the render cache, compressed when asked for
+            (response, body_gzip) = self.request('GET', '/config', headers = {'Accept-Encoding' : 'gzip'})
+            self.assertEqual((response.status, response.getheader('ETag'), response.getheader('Content-Encoding')), (200, etag, 'gzip'))
+            self.assertEqual(gzip.decompress(body_gzip), body)
+            # Not modified, answered without rendering or reading the timezones
+            (response, body) = self.request('GET', '/config', headers = {'If-None-Match' : etag})
+            self.assertEqual((response.status, body), (304, b''))
+            self.assertEqual(service.WebadminHandler.template_index.render.call_count, 0)
+            self.assertEqual(len(reads), 1)
+            # A config change makes a new page
+            (code, response) = self.post_json('/api/batch', {'operations' : [{'op' : 'playlist_new', 'playlist_name' : 'Radio'}]})
+            (response, body) = self.request('GET', '/config', headers = {'If-None-Match' : etag})
+            self.assertEqual(response.status, 200)
+            self.assertNotEqual(response.getheader('ETag'), etag)
+            self.assertTrue(b'Radio' in body)
+            self.assertEqual(service.WebadminHandler.template_index.render.call_count, 1)
+
+    def open_events(self, query, headers = {}):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        connection.request('GET', '/api/events?' + query, headers = headers)
+        response = connection.getresponse()
+        self.assertEqual((response.status, response.getheader('Content-type')), (200, 'text/event-stream'))
+        self.addCleanup(connection.close)
+        return response
+
+    def read_event(self, response):
+        fields = {}
+        while True:
+            line = response.fp.readline().decode('utf-8').rstrip('\n')
+            if line == '': return (fields['id'], json.loads(fields['data']))
+            (name, separator, value) = line.partition(': ')
+            fields[name] = value
+
+    def test_status_events(self):
+        with unittest.mock.patch.object(service, 'status_channel', service.StatusChannel()) as channel:
+            channel.publish('Kitchen', {'volume' : 10})
+            channel.publish('Bedroom', {'volume' : 20})
+            kitchen = self.open_events('zone=Kitchen')
+            both = self.open_events('zone=*')
+            self.assertEqual(self.read_event(kitchen)[1]['volume'], 10)
+            self.assertEqual(sorted([self.read_event(both)[1]['zone'] for index in range(2)]), ['Bedroom', 'Kitchen'])
+            # Other zones and unchanged statuses are not sent
+            channel.publish('Bedroom', {'volume' : 21})
+            channel.publish('Kitchen', {'volume' : 10})
+            channel.publish('Kitchen', {'volume' : 11})
+            (event_id, status) = self.read_event(kitchen)
+            self.assertEqual((status['zone'], status['volume']), ('Kitchen', 11))
+            self.assertEqual([self.read_event(both)[1]['volume'] for index in range(2)], [21, 11])
+            # A client reconnecting up to date waits for the next change
+            resumed = self.open_events('zone=Kitchen', {'Last-Event-ID' : event_id})
+            stale = self.open_events('zone=Kitchen', {'Last-Event-ID' : channel.epoch + '-1'})
+            self.assertEqual(self.read_event(stale)[1]['volume'], 11)
+            channel.publish('Kitchen', {'volume' : 12})
+            self.assertEqual(self.read_event(resumed)[1]['volume'], 12)
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class MediaHandler(QuietHandler):
+    # Serves a folder with its lengths, and an endless looking stream
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == '/stream.mp3':
+            self.send_response(200)
+            self.send_header('Content-type', 'audio/mpeg')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'x' * 1000)
+            return
+        super().do_GET()
+
+@unittest.skipIf(requests == None, 'the media cache needs requests')
+class MediaCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='clock-raspio-test-')
+        self.served = os.path.join(self.folder, 'served')
+        os.makedirs(self.served)
+        for name in ('a', 'b', 'c', 'd'):
+            with open(os.path.join(self.served, name + '.mp3'), 'wb') as file: file.write(name.encode('utf-8') * 100)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(MediaHandler, directory=self.served))
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache_folder = os.path.join(self.folder, 'cache')
+        self.cache = self.start_cache()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def start_cache(self):
+        cache = service.MediaCache(max_size = 250)
+        cache.start(logger, self.cache_folder, 'http://127.0.0.1:8080/cache/')
+        return cache
+
+    def url(self, name):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.server.server_address[1], name)
+
+    def download(self, *names):
+        self.cache.request([self.url(name) for name in names])
+        deadline = time.time() + 5
+        while len(self.cache.downloading) > 0 and time.time() < deadline: time.sleep(0.01)
+        self.assertEqual(self.cache.downloading, set())
+
+    def get_cached(self):
+        return sorted([name for name in ('a', 'b', 'c', 'd') if self.cache.is_cached(self.url(name + '.mp3'))])
+
+    def test_download_and_resolve(self):
+        self.download('a.mp3')
+        name = self.cache.get_file_name(self.url('a.mp3'))
+        self.assertEqual(os.listdir(self.cache_folder), [name])
+        with open(os.path.join(self.cache_folder, name), 'rb') as file: self.assertEqual(file.read(), b'a' * 100)
+        self.assertEqual(self.cache.resolve(self.url('a.mp3')), 'http://127.0.0.1:8080/cache/' + name)
+        # Not cached, not cacheable or not remote, the item is played as it is
+        for item in (self.url('b.mp3'), self.url('a'), 'music/a.mp3'):
+            self.assertEqual(self.cache.resolve(item), item)
+        # Already cached, not downloaded again
+        self.download('a.mp3')
+        self.assertEqual(self.server.requests, ['/a.mp3'])
+
+    def test_streams_are_not_cached(self):
+        self.download('stream.mp3', 'missing.mp3')
+        self.download('stream.mp3', 'missing.mp3')
+        self.assertEqual(os.listdir(self.cache_folder), [])
+        self.assertEqual(self.cache.resolve(self.url('stream.mp3')), self.url('stream.mp3'))
+        # Told apart once, the failed download is tried again
+        self.assertEqual(sorted(self.server.requests), ['/missing.mp3', '/missing.mp3', '/stream.mp3'])
+
+    def test_eviction(self):
+        self.download('a.mp3')
+        self.download('b.mp3')
+        # Played, a is now used more recently than b
+        self.cache.resolve(self.url('a.mp3'))
+        self.download('c.mp3')
+        self.assertEqual(self.get_cached(), ['a', 'c'])
+        # The items of the upcoming timeslots are evicted last, whatever their use
+        self.download('d.mp3', 'a.mp3')
+        self.assertEqual(self.get_cached(), ['a', 'd'])
+        self.assertEqual(self.cache.size, 200)
+        self.assertEqual(len(os.listdir(self.cache_folder)), 2)
+
+    def test_restart(self):
+        self.download('a.mp3')
+        self.download('b.mp3')
+        os.utime(os.path.join(self.cache_folder, self.cache.get_file_name(self.url('a.mp3'))), (time.time() + 10, time.time() + 10))
+        with open(os.path.join(self.cache_folder, '.cut'), 'wb') as file: file.write(b'cut')
+        self.cache = self.start_cache()
+        self.assertEqual(self.get_cached(), ['a', 'b'])
+        self.assertFalse(os.path.exists(os.path.join(self.cache_folder, '.cut')))
+        # The order of use is kept, b is evicted first
+        self.download('c.mp3')
+        self.assertEqual(self.get_cached(), ['a', 'c'])
+
+def get_free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+class FleetTest(unittest.TestCase):
+    """Two daemons, each with its own fake MPD and lib folder, driven by the
+    fleet controller."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='clock-raspio-test-')
+        self.servers = []
+        self.daemons = []
+        self.devices = []
+        for index in range(2):
+            server = fake_mpd.FakeMpdServer().start()
+            self.servers.append(server)
+            port = get_free_port()
+            lib_folder = os.path.join(self.folder, 'unit{0}'.format(index))
+            self.daemons.append(subprocess.Popen([sys.executable, SERVICE_FILE_PATH, '--port', str(port), '--mpd-port', str(server.port),
+                '--lib-folder', lib_folder, '--share-folder', os.path.join(FILES_FOLDER_PATH, 'share')],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            self.devices.append('http://127.0.0.1:{0}'.format(port))
+        for device in self.devices: self.wait_ready(device)
+        # Unreachable, it fails alone
+        self.devices.append('http://127.0.0.1:{0}'.format(get_free_port()))
+        self.config = service.Config(set_sensible_default = True).to_json()
+        self.config['playlists']['Radio'] = {'items' : ['http://radio.example/stream']}
+        self.config['current_profile_name'] = 'Holidays'
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            daemon.send_signal(signal.SIGTERM)
+            try:
+                daemon.wait(10)
+            except subprocess.TimeoutExpired:
+                daemon.kill()
+                daemon.wait()
+        for server in self.servers: server.stop()
+        shutil.rmtree(self.folder)
+
+    def wait_ready(self, device):
+        deadline = time.time() + 10
+        while True:
+            try:
+                urllib.request.urlopen(device + '/api/status', timeout=1).close()
+                return
+            except OSError:
+                if time.time() > deadline: raise
+                time.sleep(0.05)
+
+    def run_fleet(self, command):
+        return asyncio.run(fleet.run(command, self.devices, self.config, 5, 4))
+
+    def post_batch(self, device, operations):
+        request = urllib.request.Request(device + '/api/batch', json.dumps({'operations' : operations}).encode('utf-8'), {'Content-Type' : 'application/json'})
+        with urllib.request.urlopen(request, timeout=5) as response: return json.loads(response.read().decode('utf-8'))
+
+    def get_config(self, device):
+        with urllib.request.urlopen(device + '/api/config', timeout=5) as response: return json.loads(response.read().decode('utf-8'))
+
+    def test_push_status_and_drift(self):
+        # The fleet config as load_fleet reads it
+        with open(os.path.join(self.folder, 'config.json'), 'w') as file: json.dump(self.config, file)
+        with open(os.path.join(self.folder, 'fleet.json'), 'w') as file: json.dump({'config' : 'config.json', 'devices' : self.devices}, file)
+        (devices, self.config) = fleet.load_fleet(os.path.join(self.folder, 'fleet.json'))
+        self.assertEqual(sorted(self.config), ['current_profile_name', 'playlists', 'profiles', 'snooze_duration'])
+        self.post_batch(self.devices[0], [{'op' : 'zone_set', 'zone_name' : 'Kitchen', 'zone' : {'profile_name' : 'Work', 'mpd_port' : self.servers[1].port}}])
+
+        report = self.run_fleet('drift')
+        for device in self.devices[:2]: self.assertEqual(report[device], ({'drifted' : ['current_profile_name', 'playlists']}, None))
+        self.assertEqual(report[self.devices[2]][0], None)
+
+        report = self.run_fleet('push')
+        for device in self.devices[:2]: self.assertEqual(report[device][1], None)
+        self.assertNotEqual(report[self.devices[2]][1], None)
+        for device in self.devices[:2]: self.assertEqual(self.get_config(device)['playlists']['Radio'], self.config['playlists']['Radio'])
+        # Each device keeps its own zones
+        self.assertEqual(sorted(self.get_config(self.devices[0])['zones']), ['Kitchen'])
+
+        report = self.run_fleet('status')
+        for device in self.devices[:2]:
+            (result, error) = report[device]
+            self.assertEqual((result['current_profile_name'], error), ('Holidays', None))
+            self.assertTrue(result['metrics']['clock_raspio_request_seconds']['count'] > 0)
+            self.assertTrue(fleet.format_result('status', result).startswith('profile Holidays'))
+
+        # Changed behind the controller's back
+        self.post_batch(self.devices[1], [{'op' : 'playlist_add_item', 'playlist_name' : 'Radio', 'item' : 'http://radio.example/other'}])
+        report = self.run_fleet('drift')
+        self.assertEqual([report[device][0] for device in self.devices[:2]], [{'drifted' : []}, {'drifted' : ['playlists']}])
+
+@unittest.skipIf(requests == None, 'the self-update needs requests')
+class UpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        # A copy of the files folder served over HTTP, changed by the tests
+        self.folder = tempfile.mkdtemp(prefix='clock-raspio-test-')
+        self.served = os.path.join(self.folder, 'files')
+        shutil.copytree(FILES_FOLDER_PATH, self.served)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=self.served))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        self.lib = os.path.join(self.folder, 'lib')
+        os.makedirs(self.lib)
+        self.lib_folder_path = service.LIB_FOLDER_PATH
+        service.set_lib_folder(self.lib)
+        self.publications = 0
+
+    def tearDown(self):
+        service.set_lib_folder(self.lib_folder_path)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def read_installed(self):
+        installed = {}
+        for file_name in service.UPDATE_PATHS:
+            path = os.path.join(self.lib, file_name)
+            installed[file_name] = None
+            if os.path.isfile(path):
+                with open(path, 'rb') as file: installed[file_name] = file.read()
+        return installed
+
+    def publish(self, path, suffix):
+        # A new version of one file, with the manifest matching it
+        with open(os.path.join(self.served, path), 'ab') as file: file.write(suffix)
+        # Last-Modified has a one second resolution, a version published within the same second would answer 304
+        self.publications += 1
+        os.utime(os.path.join(self.served, path), (time.time() + self.publications, time.time() + self.publications))
+        manifest_path = os.path.join(self.served, service.UPDATE_MANIFEST_PATH)
+        with open(manifest_path, 'r') as file: manifest = json.load(file)
+        with open(os.path.join(self.served, path), 'rb') as file: manifest[path] = service.update_hash(file.read())
+        with open(manifest_path, 'w') as file: json.dump(manifest, file)
+
+    def test_install_then_nothing_new(self):
+        self.assertTrue(service.update_myself(logger, self.base_url))
+        with open(SERVICE_FILE_PATH, 'rb') as file:
+            self.assertEqual(self.read_installed()['clock-raspio.py'], file.read())
+        self.assertFalse(service.update_myself(logger, self.base_url))
+
+    def test_manifest_mismatch_installs_nothing(self):
+        with open(os.path.join(self.served, 'share', 'template.html'), 'ab') as file: file.write(b'<!-- tampered -->')
+        self.assertFalse(service.update_myself(logger, self.base_url))
+        self.assertEqual(os.listdir(self.lib), [])
+
+    def test_new_version(self):
+        self.assertTrue(service.update_myself(logger, self.base_url))
+        self.publish('share/template.html', b'<!-- v2 -->')
+        self.assertTrue(service.update_myself(logger, self.base_url))
+        self.assertTrue(self.read_installed()['template.html'].endswith(b'<!-- v2 -->'))
+
+    def test_interrupted_swap_rolls_back_to_one_version(self):
+        self.assertTrue(service.update_myself(logger, self.base_url))
+        self.publish('share/template.html', b'<!-- v2 -->')
+        self.publish('share/stylesheet.css', b'/* v2 */')
+        self.assertTrue(service.update_myself(logger, self.base_url))
+        v2 = self.read_installed()
+        self.publish('share/template.html', b'<!-- v3 -->')
+        self.publish('share/stylesheet.css', b'/* v3 */')
+        # The second file of the swap can not be moved in
+        replace = os.replace
+        def failing_replace(source, destination):
+            if os.path.basename(source).startswith('.update-new-') and destination.endswith('stylesheet.css'): raise OSError('No space left on device')
+            return replace(source, destination)
+        with unittest.mock.patch.object(service.os, 'replace', failing_replace):
+            self.assertFalse(service.update_myself(logger, self.base_url))
+        self.assertEqual(self.read_installed(), v2)
+        self.assertFalse(os.path.isfile(service.UPDATE_SWAP_FILE_PATH))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# Minimal MPD stand-in speaking the text protocol, used to exercise the
+# clock-raspio audio code without a sound card.
+#   python3 tools/fake-mpd.py [port]
+import socketserver
+import shlex
+import sys
+import threading
+
+FAKE_MPD_VERSION = '0.21.0'
+
+class FakeMpdState:
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.queue     = []
+        self.volume    = 0
+        self.repeat    = 0
+        self.playing   = 'stop'
+        self.history   = []
+
+class FakeMpdHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.wfile.write(('OK MPD ' + FAKE_MPD_VERSION + '\n').encode('utf-8'))
+        command_list = None
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            line = line.decode('utf-8').rstrip('\n')
+            if line == 'command_list_begin' or line == 'command_list_ok_begin':
+                command_list = []
+                list_ok = line == 'command_list_ok_begin'
+                continue
+            if line == 'command_list_end':
+                commands = command_list
+                command_list = None
+            elif command_list is not None:
+                command_list.append(line)
+                continue
+            else:
+                commands = [line]
+                list_ok = False
+            if commands == ['close']: return
+            self.wfile.write(self.execute(commands, list_ok).encode('utf-8'))
+            self.wfile.flush()
+
+    def execute(self, commands, list_ok):
+        state = self.server.state
+        output = ''
+        with state.lock:
+            for index, line in enumerate(commands):
+                args = shlex.split(line)
+                state.history.append(args)
+                try:
+                    output += self.execute_one(state, args[0], args[1:])
+                except (IndexError, ValueError) as e:
+                    return output + 'ACK [2@{0}] {{{1}}} {2}\n'.format(index, args[0] if args else '', e)
+                if list_ok: output += 'list_OK\n'
+        return output + 'OK\n'
+
+    def execute_one(self, state, name, args):
+        if name == 'ping':
+            return ''
+        if name == 'setvol':
+            volume = int(args[0])
+            if volume < 0 or volume > 100: raise ValueError('Invalid volume value')
+            state.volume = volume
+            return ''
+        if name == 'repeat':
+            state.repeat = int(args[0])
+            return ''
+        if name == 'play':
+            state.playing = 'play' if state.queue else 'stop'
+            return ''
+        if name == 'stop':
+            state.playing = 'stop'
+            return ''
+        if name == 'clear':
+            state.queue = []
+            state.playing = 'stop'
+            return ''
+        if name == 'add':
+            if args[0].startswith('missing'): raise ValueError('No such directory')
+            state.queue.append(args[0])
+            return ''
+        if name == 'delete':
+            start, separator, end = args[0].partition(':')
+            end = int(end) if end else (len(state.queue) if separator else int(start) + 1)
+            del state.queue[int(start):end]
+            return ''
+        if name == 'playlistinfo':
+            return ''.join(['file: {0}\nPos: {1}\nId: {1}\n'.format(item, pos) for pos, item in enumerate(state.queue)])
+        if name == 'status':
+            return 'volume: {0}\nrepeat: {1}\nplaylistlength: {2}\nstate: {3}\n'.format(
+                state.volume, state.repeat, len(state.queue), state.playing)
+        raise ValueError('unknown command "{0}"'.format(name))
+
+class FakeMpdServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port = 0):
+        super().__init__(('127.0.0.1', port), FakeMpdHandler)
+        self.state = FakeMpdState()
+        self.port = self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    server = FakeMpdServer(int(sys.argv[1]) if len(sys.argv) > 1 else 6600)
+    print('Fake MPD listening on port {0}'.format(server.port))
+    server.serve_forever()